@@ -0,0 +1,49 @@
+"""Micro-benchmark of field_replacer: old sequential replacer against the compiled templates.
+
+Times one call per template over the scenes of the benchmark fixture.
+
+    python benchmark/bench_templates.py --scenes 1000 --repeat 5
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import check_templates  # noqa: E402
+import fixture  # noqa: E402
+import plugin_code  # noqa: E402
+
+TEMPLATES = [
+    "$date $title [$studio]",
+    "$year $title {$performer -} $height $video_codec $tags",
+    "$studio_family - $title",
+    "$performer_path",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenes", type=int, default=1000, help="fixture scenes")
+    parser.add_argument("--repeat", type=int, default=5, help="best of")
+    args = parser.parse_args()
+    plugin = plugin_code.load(["FIELD_REGEX", "compile_template", "render_template", "field_replacer",
+                               "field_replacer_sequential"])
+    plugin["FIELD_REPLACER"] = {}
+    plugin["PREVENT_TITLE_PERF"] = False
+    dataset = fixture.generate_dataset(scenes=args.scenes)
+    infos = [fixture.scene_information(dataset, scene) for scene in dataset["scenes"]]
+    old = check_templates.baseline_field_replacer
+    new = plugin["field_replacer"]
+    width = max(len(t) for t in TEMPLATES) + 2
+    print(f"{'template':{width}}{'old us':>9}{'new us':>9}{'speedup':>9}")
+    for template in TEMPLATES:
+        timings = []
+        for run in (lambda: [old(template, info, {}, False) for info in infos],
+                    lambda: [new(template, info) for info in infos]):
+            timings.append(min(timeit.repeat(run, number=1, repeat=args.repeat)) / len(infos) * 1e6)
+        print(f"{template!r:{width}}{timings[0]:9.2f}{timings[1]:9.2f}{timings[0] / timings[1]:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Check that the compiled replace_words give the same text as the old sequential replacer.
+
+The entries are applied one after the other: a replacement can contain a later key,
+keys can overlap, and the word/any/regex modes are mixed. Exits with 1 on a difference.
+
+    python benchmark/check_replace_words.py --cases 20000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import plugin_code  # noqa: E402
+
+WORDS = ["Sun", "Sunny", "un", "Night", "Nite", "Day", "Lake", "Her", "Here", "Party", "a", "Blue", "Red"]
+SEPARATORS = [" ", " ", "_", "-", ".", " - ", "", "(", ")"]
+REGEX_KEYS = [r"\d+", r"(Sun|Day)ny", r"^\w+", r"\s+$", r"(?i)night", r"(\w)\1", r"[aeiou]{2}", r"(?P<w>Red)"]
+REGEX_REPLACEMENTS = ["#", r"\1", "", "Moon", r"\g<0>\g<0>", "Sun"]
+
+CASES = [
+    # a replacement containing a later key is replaced again
+    ({"Sun": ["Night", "any"], "Night": ["Day", "any"]}, "Sun Lake"),
+    # overlapping keys, the first one wins
+    ({"Sun": ["S", "any"], "Sunny": ["Sn", "any"], "un": ["UN", "any"]}, "Sunny Sun"),
+    ({"Sunny": ["Sn", "word"], "Sun": ["S", "word"]}, "a Sunny Sun b"),
+    # word mode needs a separator on both sides and consumes it
+    ({"Sun": "Moon"}, "Sun Sun Sun Sun"),
+    ({"Sun": ["Moon"]}, "x-Sun_Sun y"),
+    ({r"\d+": ["#", "regex"], "Sun": ["1", "any"]}, "Sun 2016 Lake"),
+    ({r"(\w)\1": [r"\1", "regex"], "Nite": ["Night", "any"]}, "Nite Party Heere"),
+]
+
+
+def baseline_replace_text(text: str, FILENAME_REPLACEWORDS: dict):
+    # replace_text before the entries were compiled, the logs removed
+    for old, new in FILENAME_REPLACEWORDS.items():
+        if type(new) is str:
+            new = [new]
+        if len(new) > 1:
+            if new[1] == "regex":
+                tmp = re.sub(old, new[0], text)
+            else:
+                if new[1] == "word":
+                    tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
+                elif new[1] == "any":
+                    tmp = text.replace(old, new[0])
+        else:
+            tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
+        text = tmp
+    return tmp
+
+
+def random_text(rng):
+    return "".join(rng.choice(WORDS + ["2016", "12"]) + rng.choice(SEPARATORS) for _ in range(rng.randint(1, 8)))
+
+
+def random_replace_words(rng):
+    replace_words = {}
+    for _ in range(rng.randint(1, 6)):
+        mode = rng.choice(["word", "any", "regex", "default", "str"])
+        if mode == "regex":
+            old, new = rng.choice(REGEX_KEYS), rng.choice(REGEX_REPLACEMENTS)
+            if r"\1" in new and not re.compile(old).groups:
+                # invalid entry, the old replacer raises and the compiled one ignores it
+                new = "#"
+            replace_words[old] = [new, "regex"]
+            continue
+        old = rng.choice(WORDS)
+        # the replacement may hold another key
+        new = rng.choice(WORDS + ["", "X", rng.choice(WORDS) + " " + rng.choice(WORDS)])
+        replace_words[old] = {"default": [new], "str": new}.get(mode, [new, mode])
+    return replace_words
+
+
+def check(plugin, replace_words, text):
+    plugin["REPLACE_WORDS"] = plugin["compile_replace_words"](replace_words)
+    expected = baseline_replace_text(text, replace_words)
+    got = plugin["replace_text"](text)
+    if got != expected:
+        print(f"DIFF {replace_words!r} {text!r}: {expected!r} (old) != {got!r} (compiled)")
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", type=int, default=20000, help="random cases")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    plugin = plugin_code.load(["compile_replace_words", "replace_text"])
+    rng = random.Random(args.seed)
+    ok = all([check(plugin, replace_words, text) for replace_words, text in CASES])
+    for _ in range(args.cases):
+        ok = check(plugin, random_replace_words(rng), random_text(rng)) and ok
+    print(f"{len(CASES) + args.cases} cases, {'same output' if ok else 'DIFFERENT output'}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
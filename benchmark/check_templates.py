@@ -0,0 +1,140 @@
+"""Check that the compiled templates give the same fields as the old sequential replacer.
+
+Every template variable is rendered, alone and next to the others, for the scenes of
+the benchmark fixture (plus scenes with awkward values: '$' in a value, the performer
+at the start of the title...). Exits with 1 on a difference.
+
+    python benchmark/check_templates.py --scenes 500 --templates 5000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fixture  # noqa: E402
+import plugin_code  # noqa: E402
+
+# the variables listed in renamerOnUpdate_config.py, and the ones only the path uses
+VARIABLES = ["oshash", "checksum", "date", "date_format", "year", "performer", "title", "height", "resolution",
+             "duration", "bitrate", "studio", "parent_studio", "studio_family", "rating", "tags", "video_codec",
+             "audio_codec", "movie_scene", "movie_title", "movie_year", "movie_index", "stashid_scene",
+             "stashid_performer", "studio_code", "performer_path"]
+SEPARATORS = [" ", " - ", "_", ".", "", " [", "] ", " {", "} ", "/", "$", "$_"]
+TEMPLATES = [
+    "$date $title [$studio]",
+    "$year_$title {$performer -} $height $video_codec $tags",
+    "$studio_family - $title",
+    "$performer_path",
+    "$date $performer - $title [$studio]",
+    "$parent_studio $date $performer - $title",
+    "$year_$title-$height",
+    "$performer $title",
+    "$title$title",
+    "$studio$studio_family",
+]
+FIELD_REPLACERS = [{}, {"$studio": {"replace": "Studio", "with": "ST"}, "$title": {"replace": "a", "with": "$"}}]
+
+
+def baseline_field_replacer(text: str, scene_information: dict, FIELD_REPLACER: dict, PREVENT_TITLE_PERF: bool):
+    # field_replacer before the templates were compiled, the logs removed
+    field_found = re.findall(r"\$\w+", text)
+    result = text
+    title = None
+    replaced_word = ""
+    if field_found:
+        field_found.sort(key=len, reverse=True)
+    for i in range(0, len(field_found)):
+        f = field_found[i].replace("$", "").strip("_")
+        # If $performer is before $title, prevent having duplicate text.
+        if f == "performer" and len(field_found) > i + 1 and scene_information.get('performer'):
+            if field_found[i+1] == "$title" and scene_information.get('title') and PREVENT_TITLE_PERF:
+                if re.search(f"^{scene_information['performer'].lower()}", scene_information['title'].lower()):
+                    result = result.replace("$performer", "")
+                    continue
+        replaced_word = scene_information.get(f)
+        if not replaced_word:
+            replaced_word = ""
+        if FIELD_REPLACER.get(f"${f}"):
+            replaced_word = replaced_word.replace(FIELD_REPLACER[f"${f}"]["replace"], FIELD_REPLACER[f"${f}"]["with"])
+        if f == "title":
+            title = replaced_word.strip()
+            continue
+        if replaced_word == "":
+            result = result.replace(field_found[i], replaced_word)
+        else:
+            result = result.replace(f"${f}", replaced_word)
+    return result, title
+
+
+def outcome(func, *args):
+    try:
+        return func(*args)
+    except Exception as err:
+        return type(err).__name__
+
+
+def scenes(count, seed):
+    """Template values of the fixture scenes, and variants of them with awkward values."""
+    dataset = fixture.generate_dataset(scenes=count, seed=seed)
+    rng = random.Random(seed)
+    for scene in dataset["scenes"]:
+        info = fixture.scene_information(dataset, scene)
+        yield info
+        variant = dict(info)
+        if info.get("performer"):
+            # the performer is already at the start of the title
+            variant["title"] = f"{info['performer']} in {info.get('title', '')}"
+        field = rng.choice(VARIABLES)
+        variant[field] = rng.choice(["", "$", "$title", "$studio x", "a$b", "title", "itle", "Studio 1", 5])
+        yield variant
+
+
+def random_template(rng):
+    return "".join(rng.choice(SEPARATORS) + "$" + rng.choice(VARIABLES + ["t", "title_", "studio_family_"])
+                   for _ in range(rng.randint(1, 5))) + rng.choice(SEPARATORS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenes", type=int, default=500, help="fixture scenes")
+    parser.add_argument("--templates", type=int, default=5000, help="random templates")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    plugin = plugin_code.load(["FIELD_REGEX", "compile_template", "render_template", "field_replacer",
+                               "field_replacer_sequential"])
+    rng = random.Random(args.seed)
+    # every variable alone, with the title and glued to the others
+    templates = list(TEMPLATES)
+    for variable in VARIABLES:
+        templates += [f"${variable}", f"${variable} $title", f"$title ${variable}", f"${variable}_$title",
+                      f"{{${variable} -}} $date"]
+        templates += [f"${variable}{sep}${other}" for other in VARIABLES for sep in ("", " ", "_")]
+    templates += [random_template(rng) for _ in range(args.templates)]
+    infos = list(scenes(args.scenes, args.seed))
+    differences = checked = compiled = 0
+    for field_replacer in FIELD_REPLACERS:
+        for prevent_title_performer in (False, True):
+            plugin["FIELD_REPLACER"] = field_replacer
+            plugin["PREVENT_TITLE_PERF"] = prevent_title_performer
+            plugin["compile_template"].cache_clear()
+            for template in templates:
+                compiled += plugin["compile_template"](template) is not None
+                # a sample of the scenes for each template, all of them for the fixed ones
+                for info in infos if template in TEMPLATES else rng.sample(infos, 20):
+                    checked += 1
+                    expected = outcome(baseline_field_replacer, template, info, field_replacer, prevent_title_performer)
+                    got = outcome(plugin["field_replacer"], template, info)
+                    if got != expected:
+                        differences += 1
+                        if differences <= 20:
+                            print(f"DIFF {template!r} {info!r}: {expected!r} (old) != {got!r} (compiled)")
+    total = len(templates) * len(FIELD_REPLACERS) * 2
+    print(f"{checked} renders of {len(templates)} templates ({compiled}/{total} compiled, the others use "
+          f"the sequential replacer), {differences} difference(s)")
+    sys.exit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""Minimal stand-in for the Stash GraphQL endpoint used by renamerOnUpdate.
+
+Only the operations the plugin sends are understood. Scene metadata comes from the
+synthetic dataset, file locations are read live from the generated SQLite database so
+renames done by the plugin are visible to later queries. Responses honour the
+selection set of the query, so payload sizes follow what the plugin asks for.
+"""
+import gzip
+import json
+import os
+import re
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fixture import DB_VERSION_FILE_REFACTOR, STASH_ENDPOINT
+
+TOKEN_RE = re.compile(r'\.\.\.|[A-Za-z_][A-Za-z0-9_]*|[{}()]|"(?:[^"\\]|\\.)*"|\$?[A-Za-z_][\w]*|[^\s]')
+
+
+def _tokenize(query):
+    return [t for t in TOKEN_RE.findall(query) if t not in (",",)]
+
+
+def _parse_block(tokens, pos):
+    """Parse ``{ ... }`` starting at tokens[pos] == '{'. Return (selection, next_pos)."""
+    selection = []
+    pos += 1
+    while tokens[pos] != "}":
+        tok = tokens[pos]
+        if tok == "...":
+            selection.append(("...", tokens[pos + 1]))
+            pos += 2
+            continue
+        name = tok
+        pos += 1
+        if pos < len(tokens) and tokens[pos] == ":":
+            name = tokens[pos + 1]
+            pos += 2
+        if tokens[pos] == "(":
+            depth = 0
+            while True:
+                if tokens[pos] == "(":
+                    depth += 1
+                elif tokens[pos] == ")":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                pos += 1
+            pos += 1
+        sub = None
+        if tokens[pos] == "{":
+            sub, pos = _parse_block(tokens, pos)
+        selection.append((name, sub))
+    return selection, pos + 1
+
+
+def parse_query(query):
+    """Return (operation selection, fragments) for a GraphQL document."""
+    tokens = _tokenize(query)
+    fragments = {}
+    operation = None
+    pos = 0
+    while pos < len(tokens):
+        if tokens[pos] == "fragment":
+            name = tokens[pos + 1]
+            while tokens[pos] != "{":
+                pos += 1
+            fragments[name], pos = _parse_block(tokens, pos)
+        elif tokens[pos] == "{":
+            operation, pos = _parse_block(tokens, pos)
+        else:
+            pos += 1
+    return operation, fragments
+
+
+def _expand(selection, fragments):
+    fields = {}
+    for name, sub in selection or []:
+        if name == "...":
+            fields.update(_expand(fragments.get(sub), fragments))
+        else:
+            fields[name] = _expand(sub, fragments) if sub is not None else None
+    return fields
+
+
+def project(value, fields):
+    if fields is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [project(v, fields) for v in value]
+    return {k: project(value.get(k), sub) for k, sub in fields.items()}
+
+
+class FakeStash:
+    def __init__(self, dataset, db_path, db_version):
+        self.db_path = db_path
+        self.db_version = db_version
+        self.studios = {s["id"]: s for s in dataset["studios"]}
+        self.performers = {p["id"]: p for p in dataset["performers"]}
+        self.tags = {t["id"]: t for t in dataset["tags"]}
+        self.movies = {m["id"]: m for m in dataset["movies"]}
+        self.scenes = {s["id"]: s for s in dataset["scenes"]}
+        self.scene_order = sorted(self.scenes)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.operations = {}
+
+    # --- data access -------------------------------------------------
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _paths(self, ids):
+        """scene id -> list of file paths, read from the database."""
+        result = {i: [] for i in ids}
+        if not ids:
+            return result
+        conn = self._connect()
+        try:
+            marks = ",".join("?" * len(ids))
+            if self.db_version >= DB_VERSION_FILE_REFACTOR:
+                rows = conn.execute(
+                    f"SELECT sf.scene_id, fo.path, f.basename FROM scenes_files sf JOIN files f ON f.id = sf.file_id "
+                    f"JOIN folders fo ON fo.id = f.parent_folder_id WHERE sf.scene_id IN ({marks}) ORDER BY sf.scene_id, f.id", ids)
+                for scene_id, folder, basename in rows:
+                    result[scene_id].append(os.path.join(folder, basename))
+            else:
+                for scene_id, path in conn.execute(f"SELECT id, path FROM scenes WHERE id IN ({marks})", ids):
+                    result[scene_id].append(path)
+        finally:
+            conn.close()
+        return result
+
+    def _studio(self, studio_id, depth=1):
+        if studio_id is None or studio_id not in self.studios:
+            return None
+        s = self.studios[studio_id]
+        data = {"id": str(s["id"]), "name": s["name"], "updated_at": s["updated_at"]}
+        if depth > 0:
+            data["parent_studio"] = self._studio(s["parent_id"], depth - 1)
+        elif s["parent_id"]:
+            data["parent_studio"] = {"id": str(s["parent_id"]), "name": self.studios[s["parent_id"]]["name"]}
+        else:
+            data["parent_studio"] = None
+        return data
+
+    def _scene(self, s, paths):
+        perf = []
+        for pid in s["performers"]:
+            p = self.performers[pid]
+            perf.append({
+                "id": str(p["id"]), "name": p["name"], "gender": p["gender"], "favorite": p["favorite"],
+                "rating": p["rating"],
+                "stash_ids": [{"endpoint": STASH_ENDPOINT, "stash_id": p["stash_id"]}] if p["stash_id"] else [],
+            })
+        movies = []
+        if s["movie"]:
+            m = self.movies[s["movie"][0]]
+            movies.append({"movie": {"name": m["name"], "date": m["date"]}, "scene_index": s["movie"][1]})
+        data = {
+            "id": str(s["id"]), "oshash": s["oshash"], "checksum": s["checksum"], "title": s["title"],
+            "date": s["date"], "rating": s["rating"], "organized": s["organized"], "code": s["code"],
+            "updated_at": s["updated_at"],
+            "stash_ids": [{"endpoint": STASH_ENDPOINT, "stash_id": s["stash_id"]}] if s["stash_id"] else [],
+            "studio": self._studio(s["studio_id"], depth=0),
+            "tags": [{"id": str(t), "name": self.tags[t]["name"]} for t in s["tags"]],
+            "performers": perf, "movies": movies,
+        }
+        if self.db_version >= DB_VERSION_FILE_REFACTOR:
+            data["files"] = [{
+                "path": path, "video_codec": s["video_codec"], "audio_codec": s["audio_codec"],
+                "width": s["width"], "height": s["height"], "frame_rate": s["frame_rate"],
+                "duration": s["duration"], "bit_rate": s["bit_rate"],
+                "fingerprints": [{"type": "oshash", "value": s["oshash"]}, {"type": "md5", "value": s["checksum"]}],
+            } for path in paths]
+        else:
+            data["path"] = paths[0] if paths else None
+            data["file"] = {
+                "video_codec": s["video_codec"], "audio_codec": s["audio_codec"], "width": s["width"],
+                "height": s["height"], "framerate": s["frame_rate"], "bitrate": s["bit_rate"],
+                "duration": s["duration"],
+            }
+        return data
+
+    # --- resolvers ---------------------------------------------------
+    def find_scenes(self, variables):
+        flt = variables.get("filter") or {}
+        scene_filter = variables.get("scene_filter") or {}
+        ids = self.scene_order
+        if variables.get("scene_ids"):
+            wanted = {int(i) for i in variables["scene_ids"]}
+            ids = [i for i in ids if i in wanted]
+        if scene_filter.get("updated_at"):
+            value = scene_filter["updated_at"]["value"]
+            ids = [i for i in ids if self.scenes[i]["updated_at"] > value]
+        if scene_filter.get("path"):
+            value = scene_filter["path"]["value"]
+            paths = self._paths(ids)
+            ids = [i for i in ids if any(p == value or os.path.basename(p) == value for p in paths[i])]
+        sort = flt.get("sort", "id")
+        if sort == "updated_at":
+            ids = sorted(ids, key=lambda i: (self.scenes[i]["updated_at"], i))
+        if flt.get("direction", "ASC") == "DESC":
+            ids = list(reversed(ids))
+        count = len(ids)
+        per_page = flt.get("per_page", 25)
+        page = flt.get("page", 1)
+        if per_page >= 0:
+            ids = ids[(page - 1) * per_page: page * per_page]
+        paths = self._paths(ids)
+        return {"count": count, "scenes": [self._scene(self.scenes[i], paths[i]) for i in ids]}
+
+    def find_scene(self, variables):
+        scene_id = int(variables["id"])
+        if scene_id not in self.scenes:
+            return None
+        return self._scene(self.scenes[scene_id], self._paths([scene_id])[scene_id])
+
+    def find_studios(self, variables):
+        flt = variables.get("filter") or {}
+        ids = sorted(self.studios)
+        if flt.get("sort") == "updated_at":
+            ids = sorted(ids, key=lambda i: (self.studios[i]["updated_at"], i))
+        if flt.get("direction", "ASC") == "DESC":
+            ids = list(reversed(ids))
+        count = len(ids)
+        per_page = flt.get("per_page", 25)
+        page = flt.get("page", 1)
+        if per_page >= 0:
+            ids = ids[(page - 1) * per_page: page * per_page]
+        return {"count": count, "studios": [self._studio(i, depth=0) for i in ids]}
+
+    def resolve(self, name, variables, library):
+        if name == "systemStatus":
+            return {"databaseSchema": self.db_version}
+        if name == "configuration":
+            return {"general": {"databasePath": self.db_path, "stashes": [{"path": library}]}}
+        if name == "findScenes":
+            return self.find_scenes(variables)
+        if name == "findScene":
+            return self.find_scene(variables)
+        if name == "findStudio":
+            return self._studio(int(variables["id"]), depth=0)
+        if name == "findStudios":
+            return self.find_studios(variables)
+        if name == "bulkSceneUpdate":
+            return [{"id": i} for i in variables["input"]["ids"]]
+        raise ValueError(f"unsupported field {name}")
+
+    def execute(self, body, library):
+        operation, fragments = parse_query(body["query"])
+        fields = _expand(operation, fragments)
+        variables = body.get("variables") or {}
+        data = {}
+        for name, sub in fields.items():
+            data[name] = project(self.resolve(name, variables, library), sub)
+            with self.lock:
+                self.operations[name] = self.operations.get(name, 0) + 1
+        return {"data": data}
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                    "operations": dict(self.operations)}
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = self.bytes_in = self.bytes_out = 0
+            self.operations = {}
+
+
+def make_handler(stash, library):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            raw = self.rfile.read(length)
+            try:
+                payload = json.dumps(stash.execute(json.loads(raw), library)).encode()
+                status = 200
+            except Exception as err:
+                payload = json.dumps({"errors": [{"message": str(err)}]}).encode()
+                status = 422
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                payload = gzip.compress(payload, 1)
+                encoding = "gzip"
+            else:
+                encoding = None
+            with stash.lock:
+                stash.requests += 1
+                stash.bytes_in += len(raw)
+                stash.bytes_out += len(payload)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+def serve(stash, library, host="127.0.0.1", port=0):
+    """Start the fake server in a daemon thread and return it."""
+    server = ThreadingHTTPServer((host, port), make_handler(stash, library))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
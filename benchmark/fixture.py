@@ -0,0 +1,281 @@
+"""Synthetic Stash library: dataset, SQLite database and placeholder files."""
+import json
+import os
+import random
+import sqlite3
+import struct
+from datetime import datetime, timedelta
+
+DB_VERSION_FILE_REFACTOR = 32
+DB_VERSION_SCENE_STUDIO_CODE = 38
+
+GENDERS = ["FEMALE", "MALE", "TRANSGENDER_FEMALE", None]
+CODECS = [("h264", "aac"), ("hevc", "aac"), ("vp9", "opus")]
+HEIGHTS = [(480, 854), (720, 1280), (1080, 1920), (2160, 3840)]
+WORDS = ["Her", "Fantasy", "Ball", "Summer", "Night", "Lake", "House", "Party", "Morning", "Sun",
+         "Blue", "Red", "City", "Road", "Trip", "Story", "Dream", "Secret", "Garden", "Rain"]
+
+REFACTOR_SCHEMA = """
+CREATE TABLE folders (id integer not null primary key autoincrement, path varchar(255) NOT NULL,
+    parent_folder_id integer, zip_file_id integer, mod_time datetime not null,
+    created_at datetime not null, updated_at datetime not null);
+CREATE UNIQUE INDEX index_folders_on_path_unique ON folders (path);
+CREATE TABLE files (id integer not null primary key autoincrement, basename varchar(255) NOT NULL,
+    zip_file_id integer, parent_folder_id integer not null, size integer NOT NULL,
+    mod_time datetime not null, created_at datetime not null, updated_at datetime not null);
+CREATE UNIQUE INDEX index_files_zip_basename_unique ON files (zip_file_id, parent_folder_id, basename);
+CREATE TABLE files_fingerprints (file_id integer NOT NULL, type varchar(255) NOT NULL, fingerprint blob NOT NULL);
+CREATE TABLE video_files (file_id integer NOT NULL primary key, duration float NOT NULL,
+    video_codec varchar(255) NOT NULL, format varchar(255) NOT NULL, audio_codec varchar(255) NOT NULL,
+    width tinyint NOT NULL, height tinyint NOT NULL, frame_rate float NOT NULL, bit_rate integer NOT NULL,
+    interactive boolean not null default '0', interactive_speed int);
+CREATE TABLE scenes (id integer not null primary key autoincrement, title varchar(255), details text,
+    url varchar(255), date date, rating tinyint, organized boolean not null default '0',
+    studio_id integer, created_at datetime not null, updated_at datetime not null{code});
+CREATE TABLE scenes_files (scene_id integer NOT NULL, file_id integer NOT NULL, "primary" boolean NOT NULL,
+    PRIMARY KEY(scene_id, file_id));
+"""
+
+LEGACY_SCHEMA = """
+CREATE TABLE scenes (id integer not null primary key autoincrement, path varchar(510) not null,
+    checksum varchar(255), oshash varchar(255), title varchar(255), details text, url varchar(255),
+    date date, rating tinyint, organized boolean not null default '0', size varchar(255),
+    duration float, video_codec varchar(255), audio_codec varchar(255), width tinyint, height tinyint,
+    framerate float, bitrate integer, studio_id integer, created_at datetime not null,
+    updated_at datetime not null);
+CREATE UNIQUE INDEX index_scenes_on_path_unique ON scenes (path);
+"""
+
+COMMON_SCHEMA = """
+CREATE TABLE studios (id integer not null primary key autoincrement, checksum varchar(255),
+    name varchar(255), url varchar(255), parent_id integer, created_at datetime not null,
+    updated_at datetime not null);
+CREATE TABLE performers (id integer not null primary key autoincrement, checksum varchar(255),
+    name varchar(255), gender varchar(20), favorite boolean not null default '0', rating tinyint,
+    created_at datetime not null, updated_at datetime not null);
+CREATE TABLE performers_scenes (performer_id integer, scene_id integer);
+CREATE TABLE performer_stash_ids (performer_id integer, endpoint varchar(255), stash_id varchar(36));
+CREATE TABLE tags (id integer not null primary key autoincrement, name varchar(255),
+    created_at datetime not null, updated_at datetime not null);
+CREATE TABLE scenes_tags (scene_id integer, tag_id integer);
+CREATE TABLE scene_stash_ids (scene_id integer, endpoint varchar(255), stash_id varchar(36));
+CREATE TABLE movies (id integer not null primary key autoincrement, name varchar(255),
+    checksum varchar(255), date date, created_at datetime not null, updated_at datetime not null);
+CREATE TABLE movies_scenes (movie_id integer, scene_id integer, scene_index tinyint);
+"""
+
+STASH_ENDPOINT = "https://stashdb.org/graphql"
+
+
+def _timestamp(dt):
+    return dt.astimezone().isoformat("T", "seconds")
+
+
+def placeholder_data(scene_id, size):
+    """Content of the placeholder file of a scene, different for every scene."""
+    return struct.pack("<Q", scene_id) * (size // 8)
+
+
+def oshash(data):
+    """Stash oshash of a file holding ``data``: size + sum of the 64-bit words of the first and last 64KiB."""
+    chunk = min(len(data), 65536)
+    words = data[:chunk] + data[-chunk:]
+    count = len(words) // 8
+    return f"{(sum(struct.unpack(f'<{count}Q', words[:count * 8])) + len(data)) & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def generate_dataset(scenes=1000, studios=60, performers=400, tags=120, movies=40, seed=1):
+    """Build a deterministic synthetic library as plain dicts."""
+    rnd = random.Random(seed)
+    base = datetime(2022, 1, 1)
+    dataset = {"studios": [], "performers": [], "tags": [], "movies": [], "scenes": []}
+    for i in range(1, studios + 1):
+        parent = None
+        # a third of the studios hang below an earlier one, giving 1-4 level networks
+        if i > 3 and rnd.random() < 0.6:
+            parent = rnd.randint(1, i - 1)
+        dataset["studios"].append({
+            "id": i, "name": f"Studio {rnd.choice(WORDS)} {i}", "parent_id": parent,
+            "updated_at": _timestamp(base + timedelta(minutes=i)),
+        })
+    for i in range(1, performers + 1):
+        dataset["performers"].append({
+            "id": i, "name": f"{rnd.choice(WORDS)} Performer{i}", "gender": rnd.choice(GENDERS),
+            "favorite": rnd.random() < 0.1, "rating": rnd.choice([None, 1, 2, 3, 4, 5]),
+            "stash_id": f"p-{i:08d}" if rnd.random() < 0.5 else None,
+        })
+    for i in range(1, tags + 1):
+        dataset["tags"].append({"id": i, "name": f"Tag{i}"})
+    for i in range(1, movies + 1):
+        dataset["movies"].append({"id": i, "name": f"Movie {rnd.choice(WORDS)} {i}",
+                                  "date": f"{rnd.randint(2000, 2022)}-01-01" if rnd.random() < 0.7 else None})
+    for i in range(1, scenes + 1):
+        height, width = rnd.choice(HEIGHTS)
+        video_codec, audio_codec = rnd.choice(CODECS)
+        date = base - timedelta(days=rnd.randint(0, 6000)) if rnd.random() < 0.85 else None
+        studio = rnd.randint(1, studios) if rnd.random() < 0.9 else None
+        dataset["scenes"].append({
+            "id": i,
+            "title": " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 5))) if rnd.random() < 0.95 else None,
+            "date": date.strftime("%Y-%m-%d") if date else None,
+            "rating": rnd.choice([None, 1, 2, 3, 4, 5]),
+            "organized": rnd.random() < 0.7,
+            "code": f"C{i:05d}" if rnd.random() < 0.3 else None,
+            "studio_id": studio,
+            "performers": sorted(rnd.sample(range(1, performers + 1), rnd.randint(0, 4))),
+            "tags": sorted(rnd.sample(range(1, tags + 1), rnd.randint(0, 6))),
+            "movie": [rnd.randint(1, movies), rnd.choice([None, 1, 2, 3])] if rnd.random() < 0.1 else None,
+            "stash_id": f"s-{i:08d}" if rnd.random() < 0.4 else None,
+            "directory": f"incoming/batch{i % 25:02d}",
+            "basename": f"scene_{i:06d}.mp4",
+            "size": 4096,
+            "oshash": oshash(placeholder_data(i, 4096)),
+            "checksum": f"{rnd.getrandbits(128):032x}",
+            "duration": round(rnd.uniform(60, 5400), 2),
+            "video_codec": video_codec, "audio_codec": audio_codec,
+            "width": width, "height": height, "frame_rate": 29.97,
+            "bit_rate": rnd.randint(1000000, 20000000),
+            "updated_at": _timestamp(base + timedelta(seconds=i)),
+        })
+    return dataset
+
+
+def create_database(path, dataset, library, db_version):
+    """Write ``dataset`` into a SQLite file that follows the Stash layout for ``db_version``."""
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    now = _timestamp(datetime.now())
+    code = ", code text" if db_version >= DB_VERSION_SCENE_STUDIO_CODE else ""
+    if db_version >= DB_VERSION_FILE_REFACTOR:
+        conn.executescript(REFACTOR_SCHEMA.format(code=code))
+    else:
+        conn.executescript(LEGACY_SCHEMA)
+    conn.executescript(COMMON_SCHEMA)
+    conn.execute("CREATE TABLE schema_migrations (version uint64 not null, dirty bool not null)")
+    conn.execute("INSERT INTO schema_migrations VALUES (?, 0)", [db_version])
+    conn.executemany("INSERT INTO studios (id, name, parent_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                     [(s["id"], s["name"], s["parent_id"], now, s["updated_at"]) for s in dataset["studios"]])
+    conn.executemany("INSERT INTO performers (id, name, gender, favorite, rating, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     [(p["id"], p["name"], p["gender"], p["favorite"], p["rating"], now, now) for p in dataset["performers"]])
+    conn.executemany("INSERT INTO performer_stash_ids VALUES (?, ?, ?)",
+                     [(p["id"], STASH_ENDPOINT, p["stash_id"]) for p in dataset["performers"] if p["stash_id"]])
+    conn.executemany("INSERT INTO tags (id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                     [(t["id"], t["name"], now, now) for t in dataset["tags"]])
+    conn.executemany("INSERT INTO movies (id, name, date, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                     [(m["id"], m["name"], m["date"], now, now) for m in dataset["movies"]])
+    folders = {}
+    if db_version >= DB_VERSION_FILE_REFACTOR:
+        def folder_id(folder):
+            if folder in folders:
+                return folders[folder]
+            parent = os.path.dirname(folder)
+            parent_id = folder_id(parent) if parent != folder and parent.startswith(library) else None
+            cur = conn.execute("INSERT INTO folders (path, parent_folder_id, mod_time, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                               [folder, parent_id, now, now, now])
+            folders[folder] = cur.lastrowid
+            return folders[folder]
+        folder_id(library)
+    for s in dataset["scenes"]:
+        directory = os.path.join(library, *s["directory"].split("/"))
+        columns = [s["id"], s["title"], s["date"], s["rating"], s["organized"], s["studio_id"], now, s["updated_at"]]
+        if db_version >= DB_VERSION_FILE_REFACTOR:
+            sql = "INSERT INTO scenes (id, title, date, rating, organized, studio_id, created_at, updated_at{}) VALUES (?, ?, ?, ?, ?, ?, ?, ?{})"
+            if code:
+                sql = sql.format(", code", ", ?")
+                columns.append(s["code"])
+            else:
+                sql = sql.format("", "")
+            conn.execute(sql, columns)
+            cur = conn.execute("INSERT INTO files (basename, parent_folder_id, size, mod_time, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                               [s["basename"], folder_id(directory), s["size"], now, now, now])
+            file_id = cur.lastrowid
+            conn.execute("INSERT INTO scenes_files VALUES (?, ?, 1)", [s["id"], file_id])
+            conn.execute("INSERT INTO video_files (file_id, duration, video_codec, format, audio_codec, width, height, frame_rate, bit_rate) VALUES (?, ?, ?, 'mp4', ?, ?, ?, ?, ?)",
+                         [file_id, s["duration"], s["video_codec"], s["audio_codec"], s["width"], s["height"], s["frame_rate"], s["bit_rate"]])
+            conn.executemany("INSERT INTO files_fingerprints VALUES (?, ?, ?)",
+                             [(file_id, "oshash", s["oshash"]), (file_id, "md5", s["checksum"])])
+        else:
+            conn.execute(
+                "INSERT INTO scenes (id, path, checksum, oshash, title, date, rating, organized, size, duration, video_codec, audio_codec, width, height, framerate, bitrate, studio_id, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [s["id"], os.path.join(directory, s["basename"]), s["checksum"], s["oshash"], s["title"], s["date"], s["rating"],
+                 s["organized"], s["size"], s["duration"], s["video_codec"], s["audio_codec"], s["width"], s["height"],
+                 s["frame_rate"], s["bit_rate"], s["studio_id"], now, s["updated_at"]])
+        conn.executemany("INSERT INTO performers_scenes VALUES (?, ?)", [(p, s["id"]) for p in s["performers"]])
+        conn.executemany("INSERT INTO scenes_tags VALUES (?, ?)", [(s["id"], t) for t in s["tags"]])
+        if s["stash_id"]:
+            conn.execute("INSERT INTO scene_stash_ids VALUES (?, ?, ?)", [s["id"], STASH_ENDPOINT, s["stash_id"]])
+        if s["movie"]:
+            conn.execute("INSERT INTO movies_scenes VALUES (?, ?, ?)", [s["movie"][0], s["id"], s["movie"][1]])
+    conn.commit()
+    conn.close()
+
+
+def create_files(dataset, library):
+    """Create a placeholder file (and sometimes a subtitle) for every scene."""
+    for s in dataset["scenes"]:
+        directory = os.path.join(library, *s["directory"].split("/"))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, s["basename"])
+        with open(path, "wb") as f:
+            f.write(placeholder_data(s["id"], s["size"]))
+        if s["id"] % 10 == 0:
+            with open(os.path.splitext(path)[0] + ".srt", "w", encoding="utf-8") as f:
+                f.write("1\n00:00:01,000 --> 00:00:02,000\nplaceholder\n")
+
+
+def scene_information(dataset, scene, library="/library"):
+    """Template values of a scene, as extract_info gives them with the default config."""
+    studios = {s["id"]: s for s in dataset["studios"]}
+    performers = {p["id"]: p for p in dataset["performers"]}
+    info = {
+        "current_path": os.path.join(library, *scene["directory"].split("/"), scene["basename"]),
+        "oshash": scene["oshash"], "checksum": scene["checksum"], "studio_code": scene["code"],
+        "duration": str(scene["duration"]),
+        "bitrate": str(round(scene["bit_rate"] / 1000000, 2)),
+        "video_codec": scene["video_codec"].upper(), "audio_codec": scene["audio_codec"].upper(),
+    }
+    if scene["stash_id"]:
+        info["stashid_scene"] = scene["stash_id"]
+    if scene["title"]:
+        info["title"] = scene["title"]
+    if scene["date"]:
+        info["date"] = info["date_format"] = scene["date"]
+        info["year"] = scene["date"][:4]
+    if scene["rating"]:
+        info["rating"] = str(scene["rating"])
+    names = [performers[p]["name"] for p in scene["performers"]]
+    if names:
+        info["performer_path"] = names[0]
+        info["performer"] = " ".join(names) if len(names) <= 3 else ""
+        info["stashid_performer"] = " ".join(performers[p]["stash_id"] for p in scene["performers"]
+                                            if len(names) <= 3 and performers[p]["stash_id"])
+    if scene["studio_id"]:
+        studio = studios[scene["studio_id"]]
+        info["studio"] = info["studio_family"] = studio["name"]
+        if studio["parent_id"]:
+            info["parent_studio"] = info["studio_family"] = studios[studio["parent_id"]]["name"]
+    if scene["tags"]:
+        info["tags"] = " ".join(f"Tag{t}" for t in scene["tags"])
+    info["resolution"] = "UHD" if scene["height"] >= 2160 else "HD" if scene["height"] >= 720 else "SD"
+    info["height"] = "4k" if scene["height"] >= 2160 else f"{scene['height']}p"
+    if scene["movie"]:
+        movie = dataset["movies"][scene["movie"][0] - 1]
+        info["movie_title"] = movie["name"]
+        if movie["date"]:
+            info["movie_year"] = movie["date"][:4]
+        if scene["movie"][1]:
+            info["movie_index"] = scene["movie"][1]
+            info["movie_scene"] = f"scene {scene['movie'][1]}"
+    return info
+
+
+def save_dataset(path, dataset):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(dataset, f)
+
+
+def load_dataset(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,107 @@
+"""Build a synthetic library, start the fake server and run the plugin against it."""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fixture  # noqa: E402
+import fake_stash  # noqa: E402
+
+REPO = os.environ.get("RENAMER_REPO", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PLUGIN_FILES = ["renamerOnUpdate.py", "renamerOnUpdate_config.py", "renamerOnUpdate.yml", "log.py"]
+
+
+class Result:
+    """Outcome of one plugin run."""
+
+    def __init__(self, returncode, stdout, stderr, elapsed, max_rss):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+        # peak resident set size of the plugin process in bytes (None if unknown)
+        self.max_rss = max_rss
+
+
+class Env:
+    def __init__(self, scenes=200, db_version=45, overrides=None, seed=1):
+        self.root = tempfile.mkdtemp(prefix="renamer_bench_")
+        self.library = os.path.join(self.root, "library")
+        self.plugin = os.path.join(self.root, "plugin")
+        os.makedirs(self.plugin)
+        self.db = os.path.join(self.root, "stash.sqlite")
+        self.db_version = db_version
+        self.dataset = fixture.generate_dataset(scenes=scenes, seed=seed)
+        fixture.create_database(self.db, self.dataset, self.library, db_version)
+        fixture.create_files(self.dataset, self.library)
+        self.stash = fake_stash.FakeStash(self.dataset, self.db, db_version)
+        self.server = fake_stash.serve(self.stash, self.library)
+        self.write_plugin(overrides or {})
+
+    def write_plugin(self, overrides):
+        """Copy the plugin next to the library, with ``overrides`` appended to its config."""
+        for f in PLUGIN_FILES:
+            shutil.copy(os.path.join(REPO, f), self.plugin)
+        with open(os.path.join(self.plugin, "renamerOnUpdate_config.py"), "a", encoding="utf-8") as f:
+            f.write("\n# benchmark overrides\n")
+            for k, v in overrides.items():
+                f.write(f"{k} = {v!r}\n")
+
+    def fragment(self, args):
+        return {
+            "server_connection": {
+                "Scheme": "http", "Host": "127.0.0.1", "Port": self.server.server_address[1],
+                "SessionCookie": {"Value": "x"}, "PluginDir": self.plugin, "Dir": self.root,
+            },
+            "args": args,
+        }
+
+    def run(self, args):
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(self.plugin, "renamerOnUpdate.py")],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, cwd=self.root)
+        output = {}
+
+        def drain(name, stream):
+            output[name] = stream.read()
+
+        readers = [threading.Thread(target=drain, args=(name, stream))
+                   for name, stream in (("stdout", proc.stdout), ("stderr", proc.stderr))]
+        for reader in readers:
+            reader.start()
+        proc.stdin.write(json.dumps(self.fragment(args)))
+        proc.stdin.close()
+        for reader in readers:
+            reader.join()
+        max_rss = None
+        if hasattr(os, "wait4"):
+            # wait4 gives the resource usage of this child alone
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            max_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        else:
+            proc.wait()
+        return Result(proc.returncode, output["stdout"], output["stderr"], time.perf_counter() - start, max_rss)
+
+    def bulk(self, mode="bulk"):
+        return self.run({"mode": mode})
+
+    def hook(self, scene_id):
+        return self.run({"hookContext": {"type": "Scene.Update.Post", "id": scene_id}})
+
+    def paths(self):
+        return self.stash._paths(self.stash.scene_order)
+
+    def close(self):
+        self.server.shutdown()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def errors(result):
+    return [line for line in result.stderr.splitlines() if line.startswith("\x01e")]
@@ -0,0 +1,39 @@
+"""Load functions of the plugin without running it (the plugin does all its work at import)."""
+import ast
+import os
+import sys
+
+import harness
+
+PLUGIN = os.path.join(harness.REPO, "renamerOnUpdate.py")
+
+
+def load(names, namespace=None):
+    """Execute the plugin's imports and the top-level definitions/assignments in ``names``.
+
+    Returns the namespace the functions run in: set the globals they read (config
+    values, indexes...) in it before calling them.
+    """
+    if harness.REPO not in sys.path:
+        # log.py of the plugin
+        sys.path.insert(0, harness.REPO)
+    with open(PLUGIN, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), PLUGIN)
+    body = []
+    missing = set(names)
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            body.append(node)
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in names:
+            body.append(node)
+            missing.discard(node.name)
+        elif isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id in names for t in node.targets):
+            body.append(node)
+            missing.difference_update(t.id for t in node.targets if isinstance(t, ast.Name))
+    if missing:
+        raise LookupError(f"not found in {PLUGIN}: {', '.join(sorted(missing))}")
+    namespace = {} if namespace is None else namespace
+    namespace.setdefault("__name__", "renamerOnUpdate")
+    exec(compile(ast.Module(body=body, type_ignores=[]), PLUGIN, "exec"), namespace)
+    namespace["log"].setLevel("error")
+    return namespace
@@ -0,0 +1,110 @@
+"""End-to-end benchmark of renamerOnUpdate against a local stand-in Stash server.
+
+Each run builds a synthetic library (SQLite database in the layout of the requested
+schema version plus placeholder files), serves it through a fake GraphQL endpoint and
+runs the plugin the same way Stash does. Reported per mode: scenes per second, GraphQL
+round trips per scene and the peak RSS of the plugin process.
+
+    python benchmark/run.py --scenes 2000 --hooks 50 --db-version 45 --db-version 31
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harness  # noqa: E402
+
+TEMPLATES = {
+    # filename only
+    "simple": lambda env: {
+        "use_default_template": True,
+        "default_template": "$date $title [$studio]",
+    },
+    # filename and a studio hierarchy folder inside the library
+    "hierarchy": lambda env: {
+        "use_default_template": True,
+        "default_template": "$date $title [$studio]",
+        "p_use_default_template": True,
+        "p_default_template": os.path.join(env.library, "$studio_hierarchy"),
+    },
+}
+
+
+def measure(env, runs):
+    """Run the plugin ``runs`` (list of args) times and aggregate the results."""
+    env.stash.reset_stats()
+    elapsed = 0
+    max_rss = None
+    errors = 0
+    for args in runs:
+        result = env.run(args)
+        elapsed += result.elapsed
+        errors += len(harness.errors(result))
+        if result.returncode != 0:
+            sys.exit(f"plugin exited with {result.returncode}:\n{result.stderr[-2000:]}")
+        if result.max_rss is not None:
+            max_rss = max(max_rss or 0, result.max_rss)
+    return elapsed, env.stash.stats(), max_rss, errors
+
+
+def bench(scenes, db_version, hooks, template):
+    rows = []
+    env = harness.Env(scenes=scenes, db_version=db_version)
+    try:
+        overrides = TEMPLATES[template](env)
+        overrides["log_file"] = os.path.join(env.root, "rename.log")
+        env.write_plugin(overrides)
+        hook_ids = [s["id"] for s in env.dataset["scenes"][:hooks]]
+        for mode, runs, count in (
+            ("hook", [{"hookContext": {"type": "Scene.Update.Post", "id": i}} for i in hook_ids], len(hook_ids)),
+            ("bulk", [{"mode": "bulk"}], scenes),
+        ):
+            if not count:
+                continue
+            elapsed, stats, max_rss, errors = measure(env, runs)
+            rows.append({
+                "mode": mode, "db_version": db_version, "scenes": count, "runs": len(runs),
+                "seconds": round(elapsed, 3),
+                "scenes_per_sec": round(count / elapsed, 1) if elapsed else None,
+                "round_trips_per_scene": round(stats["requests"] / count, 2),
+                "kib_per_scene": round((stats["bytes_in"] + stats["bytes_out"]) / count / 1024, 2),
+                "peak_rss_mib": round(max_rss / 1048576, 1) if max_rss else None,
+                "errors": errors,
+                "operations": stats["operations"],
+            })
+    finally:
+        env.close()
+    return rows
+
+
+def print_table(rows):
+    columns = ["mode", "db_version", "scenes", "runs", "seconds", "scenes_per_sec",
+               "round_trips_per_scene", "kib_per_scene", "peak_rss_mib", "errors"]
+    table = [columns] + [[str(row[c]) for c in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    for line in table:
+        print("  ".join(cell.rjust(width) for cell, width in zip(line, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenes", type=int, default=1000, help="scenes in the library (bulk mode)")
+    parser.add_argument("--hooks", type=int, default=25, help="hook invocations (one scene each)")
+    parser.add_argument("--db-version", type=int, action="append", dest="db_versions",
+                        help=f"Stash schema version, repeatable; below {harness.fixture.DB_VERSION_FILE_REFACTOR} "
+                             "uses the layout before the file refactor (default: 45 and 31)")
+    parser.add_argument("--template", choices=sorted(TEMPLATES), default="hierarchy")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    rows = []
+    for db_version in args.db_versions or [45, 31]:
+        rows.extend(bench(args.scenes, db_version, args.hooks, args.template))
+    print_table(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
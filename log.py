@@ -1,4 +1,8 @@
+import atexit
+import os
 import sys
+import threading
+import time
 
 
 # Log messages sent from a plugin instance are transmitted via stderr and are
@@ -11,6 +15,35 @@ import sys
 # formatted methods are intended for use by plugin instances to transmit log
 # messages. The LogProgress method is also intended for sending progress data.
 #
+# Messages below the level given to setLevel are dropped before being formatted:
+# pass the values as arguments (LogDebug("scene %s", scene)) or check
+# isEnabledFor("debug") so nothing is built for a message nobody reads.
+# Messages are written to sys.stderr by batch, errors and progress are written
+# at once (with the messages before them). Nothing writes a batch on a timer:
+# call flush() at the end of each scene and before anything that blocks for long
+# (a copy, a wait), so the log stays live.
+
+LEVELS = {"trace": 0, "debug": 1, "info": 2, "warning": 3, "error": 4}
+# number of messages / seconds kept before writing them
+BUFFER_SIZE = 100
+BUFFER_TIME = 0.5
+
+__level = 0
+__buffer = []
+__buffer_time = 0
+__lock = threading.Lock()
+
+
+def setLevel(level):
+	global __level
+	if level not in LEVELS:
+		raise ValueError(f"unknown log level {level!r}, use one of {', '.join(LEVELS)}")
+	__level = LEVELS[level]
+
+
+def isEnabledFor(level):
+	return LEVELS[level] >= __level
+
 
 def __prefix(level_char):
 	start_level_char = b'\x01'
@@ -20,33 +53,71 @@ def __prefix(level_char):
 	return ret.decode()
 
 
-def __log(level_char, s):
+def __write():
+	global __buffer
+	if __buffer:
+		text, __buffer = "".join(__buffer), []
+		# looked up every time, the stream can be replaced (daemon mode)
+		sys.stderr.write(text)
+		sys.stderr.flush()
+
+
+def flush():
+	with __lock:
+		__write()
+
+
+def __log(level_char, s, args=(), now=False):
+	global __buffer_time
 	if level_char == "":
 		return
+	if args:
+		s = s % args
 
-	print(__prefix(level_char) + s + "\n", file=sys.stderr, flush=True)
+	with __lock:
+		if not __buffer:
+			__buffer_time = time.monotonic()
+		__buffer.append(__prefix(level_char) + s + "\n\n")
+		if now or len(__buffer) >= BUFFER_SIZE or time.monotonic() - __buffer_time >= BUFFER_TIME:
+			__write()
 
 
-def LogTrace(s):
-	__log(b't', s)
+def LogTrace(s, *args):
+	if __level <= 0:
+		__log(b't', s, args)
 
 
-def LogDebug(s):
-	__log(b'd', s)
+def LogDebug(s, *args):
+	if __level <= 1:
+		__log(b'd', s, args)
 
 
-def LogInfo(s):
-	__log(b'i', s)
+def LogInfo(s, *args):
+	if __level <= 2:
+		__log(b'i', s, args)
 
 
-def LogWarning(s):
-	__log(b'w', s)
+def LogWarning(s, *args):
+	if __level <= 3:
+		__log(b'w', s, args)
 
 
-def LogError(s):
-	__log(b'e', s)
+def LogError(s, *args):
+	__log(b'e', s, args, now=True)
 
 
 def LogProgress(p):
 	progress = min(max(0, p), 1)
-	__log(b'p', str(progress))
+	__log(b'p', str(progress), now=True)
+
+
+def __after_fork():
+	global __buffer, __lock
+	# the messages of the parent are written by the parent, its lock may be held by another thread
+	__buffer = []
+	__lock = threading.Lock()
+
+
+atexit.register(flush)
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=__after_fork)
@@ -1,15 +1,207 @@
+import bisect
 import difflib
+import errno
+import functools
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
+import pickle
 import re
 import shutil
+import socket
 import sqlite3
+import stat
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
-from datetime import datetime
+import types
+import urllib.request
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+try:
+    import renamerOnUpdate_config as config
+except Exception:
+    import config
+import log
+
+log.setLevel(config.log_level)
+
+
+START_TIME = time.time()
+FRAGMENT = json.loads(sys.stdin.read())
+# started by a hook to handle the next ones (daemon_mode)
+DAEMON = "--daemon" in sys.argv
+# in a folder of the user, only the user can use or replace the socket
+DAEMON_SOCKET = config.daemon_socket or os.path.join(tempfile.gettempdir(), f"renamerOnUpdate-{os.getuid() if hasattr(os, 'getuid') else 0}",
+                                                     f"{hashlib.md5(os.path.dirname(os.path.abspath(__file__)).encode()).hexdigest()[:10]}.sock")
+
+
+def lock_file(path: str):
+    """Take an exclusive lock on path without waiting, None if another process has it."""
+    # not truncated, and never a file a symlink points to
+    f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600), 'r+')
+    try:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def unlock_file(f):
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    f.close()
+
+
+def hook_queue_scenes() -> list:
+    scenes = []
+    with os.scandir(HOOK_QUEUE_DIR) as entries:
+        for entry in entries:
+            if entry.name.isdigit():
+                scenes.append(entry)
+    return scenes
+
+
+def hook_queue_recover():
+    """Queue again the scenes claimed by a run that stopped before renaming them (called with the queue lock)."""
+    with os.scandir(HOOK_QUEUE_DIR) as entries:
+        claims = [entry for entry in entries if entry.name.endswith(".claimed")]
+    for entry in claims:
+        log.LogInfo(f"Queueing again the scene {entry.name[:-len('.claimed')]} (the previous run stopped)")
+        try:
+            os.replace(entry.path, entry.path[:-len(".claimed")])
+        except FileNotFoundError:
+            pass
+
+
+def hook_queue_done(scene_id: int):
+    # the scene was handled, its claim can go
+    try:
+        os.remove(os.path.join(HOOK_QUEUE_DIR, f"{scene_id}.claimed"))
+    except FileNotFoundError:
+        pass
+
+
+def hook_queue_take() -> list:
+    """Wait until no hook added a scene for hook_queue_delay seconds, then claim the queue and return the scene ids.
+
+    The scenes stay in the queue folder as '<id>.claimed' until hook_queue_done, so they
+    are not lost if the run stops.
+    """
+    start = time.time()
+    while True:
+        scenes = hook_queue_scenes()
+        if not scenes:
+            return []
+        wait = max(entry.stat().st_mtime for entry in scenes) + config.hook_queue_delay - time.time()
+        # don't wait forever if the updates never stop
+        if wait <= 0 or time.time() - start > config.hook_queue_delay * 10:
+            break
+        log.flush()
+        time.sleep(min(wait, config.hook_queue_delay))
+    scene_ids = []
+    for entry in scenes:
+        try:
+            os.replace(entry.path, entry.path + ".claimed")
+        except FileNotFoundError:
+            continue
+        scene_ids.append(int(entry.name))
+    return sorted(scene_ids)
+
+
+def daemon_folder() -> bool:
+    """Create the folder of DAEMON_SOCKET (for the user only), False if another user can write in it."""
+    folder = os.path.dirname(DAEMON_SOCKET)
+    try:
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        st = os.lstat(folder)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+        log.LogWarning(f"[Daemon] {folder} can be changed by other users, the daemon is not used")
+        return False
+    return True
+
+
+def daemon_forward(fragment: dict) -> bool:
+    """Give the hook to the daemon and relay its logs, False if there is no daemon to handle it."""
+    # the fragment holds the session of Stash, it's only sent to a socket of this user
+    if not daemon_folder():
+        return False
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(DAEMON_SOCKET)
+    except OSError:
+        return False
+    with client, client.makefile('rw', encoding='utf-8') as stream:
+        stream.write(json.dumps(fragment) + "\n")
+        stream.flush()
+        for line in stream:
+            if line.startswith("\0"):
+                print(line[1:], end="")
+                return True
+            sys.stderr.write(line)
+            sys.stderr.flush()
+    # the daemon stopped (restart), this process has to do it
+    return False
+
+
+def daemon_start(fragment: dict):
+    try:
+        daemon = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--daemon"], stdin=subprocess.PIPE,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        daemon.stdin.write(json.dumps(fragment).encode())
+        daemon.stdin.close()
+    except Exception as err:
+        log.LogWarning(f"[Daemon] Can't start the daemon: {err}")
+
+
+# scenes updated by the hooks, renamed together by one of them (hook_queue)
+HOOK_QUEUE_DIR = config.hook_queue_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "hook_queue")
+HOOK_QUEUE_LOCK = None
+if config.hook_queue and not FRAGMENT['args'].get("mode") and config.enable_hook:
+    os.makedirs(HOOK_QUEUE_DIR, exist_ok=True)
+    # the file name is the scene id, so a scene is only once in the queue
+    with open(os.path.join(HOOK_QUEUE_DIR, str(FRAGMENT['args']['hookContext']['id'])), 'w'):
+        pass
+    HOOK_QUEUE_LOCK = lock_file(os.path.join(HOOK_QUEUE_DIR, "queue.lock"))
+    if HOOK_QUEUE_LOCK is None:
+        # another hook is renaming the queue, it will take this scene too
+        print(json.dumps({"output": "Scene queued", "error": None}))
+        sys.exit()
+# forward the hook before loading everything else
+elif config.daemon_mode and not DAEMON and not FRAGMENT['args'].get("mode") and config.enable_hook and hasattr(socket, "AF_UNIX"):
+    if daemon_forward(FRAGMENT):
+        sys.exit()
+    # this hook is done here, the next ones by the daemon
+    daemon_start(FRAGMENT)
+
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import brotli  # noqa: F401 pip install brotli (urllib3 only decodes 'br' when it is installed)
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except Exception:
+    ACCEPT_ENCODING = "gzip, deflate"
 
 try:
     import psutil  # pip install psutil
@@ -24,13 +216,6 @@ except Exception:
     MODULE_UNIDECODE = False
 
 
-try:
-    import renamerOnUpdate_config as config
-except Exception:
-    import config
-import log
-
-
 DB_VERSION_FILE_REFACTOR = 32
 DB_VERSION_SCENE_STUDIO_CODE = 38
 
@@ -46,43 +231,128 @@ if DRY_RUN:
             os.remove(DRY_RUN_FILE)
     log.LogInfo("Dry mode on")
 
-START_TIME = time.time()
-FRAGMENT = json.loads(sys.stdin.read())
 
 FRAGMENT_SERVER = FRAGMENT["server_connection"]
 PLUGIN_DIR = FRAGMENT_SERVER["PluginDir"]
 
 
 PLUGIN_ARGS = FRAGMENT['args'].get("mode")
+GRAPHQL_CLIENT = None
+PHASE_STATS = None
+RENAME_JOURNAL = None
+DRY_RUN_JOURNAL = None
 
 #log.LogDebug("{}".format(FRAGMENT))
 
 
+class GraphQLClient:
+    """Keep-alive session to the Stash GraphQL endpoint, created once per process."""
+
+    def __init__(self, server: dict):
+        graphql_domain = server['Host']
+        if graphql_domain == "0.0.0.0":
+            graphql_domain = "localhost"
+        # Stash GraphQL endpoint
+        self.url = f"{server['Scheme']}://{graphql_domain}:{server['Port']}/graphql"
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Accept-Encoding": ACCEPT_ENCODING,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Connection": "keep-alive",
+            "DNT": "1"
+        })
+        # Session cookie for authentication
+        self.session.cookies.set('session', server['SessionCookie']['Value'])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.graphql_pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        # circuit breaker: closed, open (no request until open_until) then half-open (one request tries Stash again)
+        self.state = "closed"
+        self.failures = 0
+        self.open_until = 0
+        # traffic
+        self.requests = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+
+    def _acquire(self) -> bool:
+        """Return True when the request is the probe of the half-open breaker, raise while it's open."""
+        with self.lock:
+            if self.state == "closed":
+                return False
+            if self.state == "open" and time.time() >= self.open_until:
+                self.state = "half-open"
+                return True
+        raise ConnectionError("GraphQL circuit open, too many failed requests to Stash")
+
+    def _open(self):
+        self.state = "open"
+        self.open_until = time.time() + config.graphql_breaker_cooldown
+
+    def _succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.state = "closed"
+
+    def _failed(self, probe: bool):
+        with self.lock:
+            self.failures += 1
+            if probe or self.failures >= config.graphql_breaker_threshold:
+                self._open()
+                return True
+        return False
+
+    def post(self, query, variables=None):
+        probe = self._acquire()
+        payload = {'query': query}
+        if variables is not None:
+            payload['variables'] = variables
+        data = json.dumps(payload).encode("utf-8")
+        # the probe doesn't retry, Stash is still down if it fails
+        attempts = 1 if probe else config.graphql_retries + 1
+        try:
+            for attempt in range(attempts):
+                if attempt:
+                    with self.lock:
+                        self.retries += 1
+                    time.sleep(config.graphql_retry_backoff * 2 ** (attempt - 1))
+                try:
+                    response = self.session.post(self.url, data=data, timeout=config.graphql_timeout)
+                    content = response.content
+                except (requests.ConnectionError, requests.Timeout) as err:
+                    error = err
+                else:
+                    with self.lock:
+                        self.requests += 1
+                        self.bytes_sent += len(data)
+                        self.bytes_received += response.raw.tell() if hasattr(response.raw, "tell") else len(content)
+                        self.bytes_decoded += len(content)
+                    if response.status_code not in (429, 502, 503, 504):
+                        self._succeeded()
+                        return response
+                    error = f"HTTP Error {response.status_code}"
+                log.LogWarning(f"GraphQL request failed ({error}), attempt {attempt + 1}/{attempts}")
+                if self._failed(probe):
+                    break
+        finally:
+            if probe:
+                with self.lock:
+                    # the probe ended with another error
+                    if self.state == "half-open":
+                        self._open()
+        raise ConnectionError(f"[FATAL] Error with the graphql request {error}")
+
+    def stats(self):
+        return f"{self.requests} requests ({self.retries} retries), {self.bytes_sent} bytes sent, " \
+               f"{self.bytes_received} bytes received ({self.bytes_decoded} decoded)"
+
+
 def callGraphQL(query, variables=None):
-    # Session cookie for authentication
-    graphql_port = str(FRAGMENT_SERVER['Port'])
-    graphql_scheme = FRAGMENT_SERVER['Scheme']
-    graphql_cookies = {'session': FRAGMENT_SERVER['SessionCookie']['Value']}
-    graphql_headers = {
-        "Accept-Encoding": "gzip, deflate, br",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Connection": "keep-alive",
-        "DNT": "1"
-    }
-    graphql_domain = FRAGMENT_SERVER['Host']
-    if graphql_domain == "0.0.0.0":
-        graphql_domain = "localhost"
-    # Stash GraphQL endpoint
-    graphql_url = f"{graphql_scheme}://{graphql_domain}:{graphql_port}/graphql"
-
-    json = {'query': query}
-    if variables is not None:
-        json['variables'] = variables
-    try:
-        response = requests.post(graphql_url, json=json, headers=graphql_headers, cookies=graphql_cookies, timeout=20)
-    except Exception as e:
-        exit_plugin(err=f"[FATAL] Error with the graphql request {e}")
+    response = GRAPHQL_CLIENT.post(query, variables)
     if response.status_code == 200:
         result = response.json()
         if result.get("error"):
@@ -97,6 +367,47 @@ def callGraphQL(query, variables=None):
         raise ConnectionError(f"GraphQL query failed: {response.status_code} - {response.content}")
 
 
+@functools.lru_cache(maxsize=4)
+def scene_query_fields(fingerprint: str) -> str:
+    """Fields asked for a scene: only what the templates and options of the config (fingerprint) can use."""
+    templates = [PATH_NON_ORGANIZED]
+    if config.use_default_template:
+        templates.append(config.default_template)
+    if config.p_use_default_template:
+        templates.append(config.p_default_template)
+    for templates_by in (config.tag_templates, config.studio_templates, config.p_tag_templates, config.p_studio_templates, config.p_path_templates):
+        templates.extend(templates_by.values())
+    # $performer_$title gives $performer_, the fields are found by prefix
+    found = set(FIELD_REGEX.findall(" ".join(str(t) for t in templates if t)))
+
+    def uses(*fields):
+        return any(f.startswith(field) for f in found for field in fields)
+
+    query = ["id", "oshash", "checksum", "title", "date", "organized"]
+    if uses("$rating"):
+        query.append("rating")
+    if uses("$stashid_scene"):
+        query.append("stash_ids { endpoint stash_id }")
+    if uses("$studio", "$parent_studio") or config.studio_templates or config.p_studio_templates:
+        query.append("studio { id name parent_studio { id name } }")
+    if uses("$tags") or config.tag_templates or config.p_tag_templates or config.p_tag_option:
+        query.append("tags { id name }")
+    if uses("$performer", "$stashid_performer"):
+        performer = ["name"]
+        if PERFORMER_IGNOREGENDER:
+            performer.append("gender")
+        if PERFORMER_SORT in ("favorite", "mix", "mixid"):
+            performer.append("favorite")
+        if PERFORMER_SORT in ("rating", "mix", "mixid"):
+            performer.append("rating")
+        if uses("$stashid_performer"):
+            performer.append("stash_ids { endpoint stash_id }")
+        query.append(f"performers {{ {' '.join(performer)} }}")
+    if uses("$movie"):
+        query.append("movies { movie { name date } scene_index }")
+    return "\n        ".join(query) + FILE_QUERY
+
+
 def graphql_getScene(scene_id):
     query = """
     query FindScene($id: ID!, $checksum: String) {
@@ -105,47 +416,7 @@ def graphql_getScene(scene_id):
         }
     }
     fragment SceneData on Scene {
-        id
-        oshash
-        checksum
-        title
-        date
-        rating
-        stash_ids {
-            endpoint
-            stash_id
-        }
-        organized""" + FILE_QUERY + """
-        studio {
-            id
-            name
-            parent_studio {
-                id
-                name
-            }
-        }
-        tags {
-            id
-            name
-        }
-        performers {
-            id
-            name
-            gender
-            favorite
-            rating
-            stash_ids{
-                endpoint
-                stash_id
-            }
-        }
-        movies {
-            movie {
-                name
-                date
-            }
-            scene_index
-        }
+        """ + scene_query_fields(CONFIG_FINGERPRINT) + """
     }
     """
     variables = {
@@ -156,10 +427,10 @@ def graphql_getScene(scene_id):
 
 
 # used for bulk
-def graphql_findScene(perPage, direc="DESC") -> dict:
+def graphql_findScene(perPage, direc="DESC", page=1, sort="updated_at", scene_ids=None, scene_filter=None) -> dict:
     query = """
-    query FindScenes($filter: FindFilterType) {
-        findScenes(filter: $filter) {
+    query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType, $scene_ids: [Int!]) {
+        findScenes(filter: $filter, scene_filter: $scene_filter, scene_ids: $scene_ids) {
             count
             scenes {
                 ...SlimSceneData
@@ -167,54 +438,51 @@ def graphql_findScene(perPage, direc="DESC") -> dict:
         }
     }
     fragment SlimSceneData on Scene {
-        id
-        oshash
-        checksum
-        title
-        date
-        rating
-        organized
-        stash_ids {
-            endpoint
-            stash_id
-        }
-    """ + FILE_QUERY + """
-        studio {
-            id
-            name
-            parent_studio {
+        """ + scene_query_fields(CONFIG_FINGERPRINT) + """
+    }
+    """
+    # ASC DESC
+    variables = {'filter': {"direction": direc, "page": page, "per_page": perPage, "sort": sort}, 'scene_filter': scene_filter, 'scene_ids': scene_ids}
+    result = callGraphQL(query, variables)
+    return result.get("findScenes")
+
+
+def graphql_findSceneIds(scene_filter=None) -> list:
+    """Ids of all the scenes matching scene_filter, sorted."""
+    query = """
+    query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType) {
+        findScenes(filter: $filter, scene_filter: $scene_filter) {
+            scenes {
                 id
-                name
-            }
-        }
-        tags {
-            id
-            name
-        }
-        performers {
-            id
-            name
-            gender
-            favorite
-            rating
-            stash_ids{
-                endpoint
-                stash_id
             }
         }
-        movies {
-            movie {
-                name
-                date
-            }
-            scene_index
-        }
     }
     """
-    # ASC DESC
-    variables = {'filter': {"direction": direc, "page": 1, "per_page": perPage, "sort": "updated_at"}}
+    variables = {'filter': {"direction": "ASC", "page": 1, "per_page": -1, "sort": "id"}, 'scene_filter': scene_filter}
     result = callGraphQL(query, variables)
-    return result.get("findScenes")
+    return sorted(int(scene["id"]) for scene in result["findScenes"]["scenes"])
+
+
+def graphql_findScenePages(limit: int, page_size: int, direc="ASC", scene_ids=None, scene_filter=None):
+    """Yield (total, scenes) page by page, the next page is fetched while the current one is processed."""
+    if page_size <= 0 or 0 < limit <= page_size:
+        page_size = limit
+    # sort by id, updated_at moves while we rename (clean_tag) and would shift the pages
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = 1
+        future = executor.submit(graphql_findScene, page_size, direc, page, "id", scene_ids, scene_filter)
+        fetched = 0
+        while future:
+            result = future.result()
+            total = result["count"] if limit < 0 else min(limit, result["count"])
+            scenes = result["scenes"][:total - fetched]
+            fetched += len(scenes)
+            future = None
+            if page_size > 0 and fetched < total and len(result["scenes"]) == page_size:
+                page += 1
+                future = executor.submit(graphql_findScene, page_size, direc, page, "id", scene_ids, scene_filter)
+            del result
+            yield total, scenes
 
 
 # used to find duplicate
@@ -256,6 +524,9 @@ def graphql_getConfiguration():
             configuration {
                 general {
                     databasePath
+                    stashes {
+                        path
+                    }
                 }
             }
         }
@@ -284,6 +555,27 @@ def graphql_getStudio(studio_id):
     return result.get("findStudio")
 
 
+def graphql_findStudios(perPage, direc="ASC", sort="id") -> dict:
+    query = """
+        query FindStudios($filter: FindFilterType) {
+            findStudios(filter: $filter) {
+                count
+                studios {
+                    id
+                    name
+                    updated_at
+                    parent_studio {
+                        id
+                    }
+                }
+            }
+        }
+    """
+    variables = {'filter': {"direction": direc, "page": 1, "per_page": perPage, "sort": sort}}
+    result = callGraphQL(query, variables)
+    return result.get("findStudios")
+
+
 def graphql_removeScenesTag(id_scenes: list, id_tags: list):
     query = """
     mutation BulkSceneUpdate($input: BulkSceneUpdateInput!) {
@@ -309,6 +601,98 @@ def graphql_getBuild():
     return result['systemStatus']['databaseSchema']
 
 
+class StudioIndex:
+    """Parent-pointer index of the studios.
+
+    With preload (bulk, daemon, cache file), every studio is loaded once with findStudios.
+    Else (one hook) the studios are asked one by one with findStudio and kept.
+    """
+
+    def __init__(self, cache_file=None, preload=False):
+        self.cache_file = cache_file
+        self.preload = preload
+        self.studios = None
+        self.loaded_version = None
+
+    def load(self):
+        version = self.version()
+        if self.cache_file and os.path.isfile(self.cache_file):
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+                if cache.get("version") == version:
+                    self.studios = cache["studios"]
+                    self.loaded_version = version
+                    log.LogDebug(f"[Studio] {len(self.studios)} studios loaded from cache")
+                    return
+            except Exception as err:
+                log.LogWarning(f"[Studio] Ignoring the studio cache ({err})")
+        self.studios = {}
+        self.loaded_version = version
+        for studio in graphql_findStudios(-1)["studios"]:
+            self.add(studio)
+        log.LogDebug(f"[Studio] {len(self.studios)} studios loaded")
+        if self.cache_file:
+            try:
+                with open(self.cache_file, 'w', encoding='utf-8') as f:
+                    json.dump({"version": version, "studios": self.studios}, f)
+            except Exception as err:
+                log.LogWarning(f"[Studio] Can't write the studio cache ({err})")
+
+    def version(self) -> list:
+        # the most recently updated studio tells us if the index is still valid
+        latest = graphql_findStudios(1, "DESC", "updated_at")
+        return [latest["count"], latest["studios"][0]["updated_at"] if latest["studios"] else None]
+
+    def refresh(self):
+        """Forget the index if a studio changed since it was loaded (daemon)."""
+        if self.loaded_version is not None and self.version() != self.loaded_version:
+            self.studios = None
+
+    def add(self, studio: dict):
+        parent = studio.get("parent_studio")
+        self.studios[str(studio["id"])] = {
+            "id": str(studio["id"]),
+            "name": studio["name"],
+            "parent_id": str(parent["id"]) if parent else None
+        }
+
+    def ready(self):
+        if self.studios is None:
+            if self.preload:
+                self.load()
+            else:
+                self.studios = {}
+
+    def get(self, studio_id):
+        self.ready()
+        studio = self.studios.get(str(studio_id))
+        if studio is None:
+            # not asked yet, or created after the index was loaded
+            studio = graphql_getStudio(studio_id)
+            if studio is None:
+                return None
+            self.add(studio)
+            studio = self.studios[str(studio_id)]
+        return studio
+
+    def parents(self, scene_studio: dict) -> list:
+        """Parents of the studio of a scene (id, name, parent_studio), the closest first."""
+        self.ready()
+        if str(scene_studio["id"]) not in self.studios:
+            # the scene already gives the studio and its parent
+            self.add(scene_studio)
+        parents = []
+        seen = {str(scene_studio["id"])}
+        studio = self.studios[str(scene_studio["id"])]
+        while studio and studio["parent_id"] and studio["parent_id"] not in seen:
+            seen.add(studio["parent_id"])
+            studio = self.get(studio["parent_id"])
+            if studio:
+                parents.append(studio)
+        return parents
+
+
 def find_diff_text(a: str, b: str):
     addi = minus = stay = ""
     minus_ = addi_ = 0
@@ -332,18 +716,90 @@ def find_diff_text(a: str, b: str):
     return
 
 
+class OpenFileIndex:
+    """Which processes have a file open, built in one pass over all processes and kept a few seconds."""
+
+    def __init__(self, cache_time=0):
+        self.cache_time = cache_time
+        self.files = None
+        self.built = 0
+        # the moves run in threads (bulk_workers)
+        self.lock = threading.Lock()
+        # /proc gives the inode of every open file (Linux), else ask psutil for the paths
+        self.use_proc = os.path.isdir("/proc/self/fd")
+
+    def key(self, path: str):
+        if self.use_proc:
+            st = os.stat(path)
+            return st.st_dev, st.st_ino
+        return os.path.normcase(os.path.abspath(path))
+
+    def build(self):
+        self.files = {}
+        me = os.getpid()
+        if self.use_proc:
+            for pid in os.listdir("/proc"):
+                if not pid.isdigit() or int(pid) == me:
+                    continue
+                fd_dir = f"/proc/{pid}/fd"
+                try:
+                    fds = os.listdir(fd_dir)
+                except OSError:
+                    continue
+                for fd in fds:
+                    try:
+                        st = os.stat(os.path.join(fd_dir, fd))
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        self.files.setdefault((st.st_dev, st.st_ino), set()).add(int(pid))
+        else:
+            for proc in psutil.process_iter():
+                if proc.pid == me:
+                    continue
+                try:
+                    for item in proc.open_files():
+                        self.files.setdefault(os.path.normcase(item.path), set()).add(proc.pid)
+                except Exception:
+                    pass
+        self.built = time.time()
+
+    def invalidate(self):
+        with self.lock:
+            self.files = None
+
+    def pids(self, path: str) -> list:
+        try:
+            key = self.key(path)
+        except OSError:
+            return []
+        with self.lock:
+            if self.files is None or time.time() - self.built > self.cache_time:
+                self.build()
+            return sorted(self.files.get(key, ()))
+
+
+def file_in_use(err: OSError) -> bool:
+    """The move failed because another process has the file open.
+
+    A permission error (EACCES) is not one: an open file never prevents a rename on
+    Linux/macOS, the process holding it must not be killed for it.
+    """
+    if getattr(err, "winerror", None) == 32 or "[WinError 32]" in str(err):
+        return True
+    return os.name != "nt" and err.errno in (errno.EBUSY, errno.ETXTBSY)
+
+
 def has_handle(fpath, all_result=False):
     lst = []
-    for proc in psutil.process_iter():
+    for pid in OPEN_FILES.pids(fpath):
         try:
-            for item in proc.open_files():
-                if fpath == item.path:
-                    if all_result:
-                        lst.append(proc)
-                    else:
-                        return proc
-        except Exception:
-            pass
+            proc = psutil.Process(pid)
+        except psutil.Error:
+            continue
+        if not all_result:
+            return proc
+        lst.append(proc)
     return lst
 
 
@@ -377,21 +833,19 @@ def get_template_filename(scene: dict):
     template = None
     # Change by Studio
     if scene.get("studio") and config.studio_templates:
-        template_found = False
         current_studio = scene.get("studio")
         if config.studio_templates.get(current_studio['name']):
             template = config.studio_templates[current_studio['name']]
-            template_found = True
-        # by first Parent found
-        while current_studio.get("parent_studio") and not template_found:
-            if config.studio_templates.get(current_studio.get("parent_studio").get("name")):
-                template = config.studio_templates[current_studio['parent_studio']['name']]
-                template_found = True
-            current_studio = graphql_getStudio(current_studio.get("parent_studio")['id'])
+        elif current_studio.get("parent_studio"):
+            # by first Parent found
+            for parent in STUDIO_INDEX.parents(current_studio):
+                if config.studio_templates.get(parent['name']):
+                    template = config.studio_templates[parent['name']]
+                    break
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
-    if scene.get("tags") and config.tag_templates:
+    tags = [x["name"] for x in scene.get("tags") or []]
+    if tags and config.tag_templates:
         for match, job in config.tag_templates.items():
             if match in tags:
                 template = job
@@ -418,8 +872,8 @@ def get_template_path(scene: dict):
                 template["destination"] = config.p_studio_templates[scene["studio"]["name"]]
 
     # Change by Tag
-    tags = [x["name"] for x in scene["tags"]]
-    if scene.get("tags") and config.p_tag_templates:
+    tags = [x["name"] for x in scene.get("tags") or []]
+    if tags and config.p_tag_templates:
         for match, job in config.p_tag_templates.items():
             if match in tags:
                 template["destination"] = job
@@ -540,7 +994,7 @@ def extract_info(scene: dict, template: None):
             # if the path already contains the name we keep this one
             if perf["name"] in scene_information['current_path_split'] and scene_information.get('performer_path') is None and PATH_KEEP_ALRPERF:
                 scene_information['performer_path'] = perf["name"]
-                log.LogDebug(f"[PATH] Keeping the current name of the performer '{perf['name']}'")
+                log.LogDebug("[PATH] Keeping the current name of the performer '%s'", perf['name'])
         perf_rating = sort_rating(perf_rating)
         # sort performer
         if PERFORMER_SORT == "rating":
@@ -604,14 +1058,11 @@ def extract_info(scene: dict, template: None):
                 scene_information['parent_studio'] = scene['studio']['parent_studio']['name']
             scene_information['studio_family'] = scene_information['parent_studio']
 
-            studio_p = scene['studio']
-            while studio_p.get("parent_studio"):
-                studio_p = graphql_getStudio(studio_p['parent_studio']['id'])
-                if studio_p:
-                    if SQUEEZE_STUDIO_NAMES:
-                        studio_hierarchy.append(studio_p['name'].replace(' ', ''))
-                    else:
-                        studio_hierarchy.append(studio_p['name'])
+            for studio_p in STUDIO_INDEX.parents(scene['studio']):
+                if SQUEEZE_STUDIO_NAMES:
+                    studio_hierarchy.append(studio_p['name'].replace(' ', ''))
+                else:
+                    studio_hierarchy.append(studio_p['name'])
             studio_hierarchy.reverse()
         scene_information['studio_hierarchy'] = studio_hierarchy
     # Grab Tags
@@ -674,28 +1125,77 @@ def extract_info(scene: dict, template: None):
     return scene_information
 
 
-def replace_text(text: str):
-    for old, new in FILENAME_REPLACEWORDS.items():
+def compile_replace_words(replace_words: dict):
+    """Compile replace_words once. Return a pattern that matches if any entry could apply (None if it can't be built) and the entries."""
+    entries = []
+    gate = {"regex": [], "word": [], "any": []}
+    gate_usable = True
+    for old, new in replace_words.items():
         if type(new) is str:
             new = [new]
-        if len(new) > 1:
-            if new[1] == "regex":
-                tmp = re.sub(old, new[0], text)
-                if tmp != text:
-                    log.LogDebug(f"Regex matched: {text} -> {tmp}")
+        if not new:
+            log.LogWarning(f"replace_words: no replacement for '{old}', ignored")
+            continue
+        system = new[1] if len(new) > 1 else "word"
+        try:
+            if system == "regex":
+                pattern = re.compile(old)
+                replacement = new[0]
+                gate["regex"].append(f"(?:{old})")
+            elif system == "word":
+                pattern = re.compile(fr'([\s_-])({old})([\s_-])')
+                replacement = f'\\1{new[0]}\\3'
+                gate["word"].append(f"(?:{old})")
+            elif system == "any":
+                pattern = None
+                replacement = new[0]
+                gate["any"].append(re.escape(old))
             else:
-                if new[1] == "word":
-                    tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
-                elif new[1] == "any":
-                    tmp = text.replace(old, new[0])
-                if tmp != text:
-                    log.LogDebug(f"'{old}' changed with '{new[0]}'")
+                log.LogWarning(f"replace_words: unknown type '{system}' for '{old}', ignored")
+                continue
+            if pattern:
+                # check the replacement (group references)
+                pattern.sub(replacement, "")
+        except re.error as err:
+            log.LogError(f"replace_words: invalid entry '{old}' ({err}), ignored")
+            continue
+        # the text must contain it, no need to run the regex otherwise
+        literal = None
+        if system == "any" or not re.search(r"[.^$*+?{}\[\]\\|()]", old):
+            literal = old
+        # backreferences and inline flags would change meaning once joined with the others
+        if re.search(r"\\[1-9]|\(\?P=|\(\?\(", old) or (pattern and pattern.flags != re.UNICODE):
+            gate_usable = False
+        entries.append((old, system, pattern, replacement, literal, new[0]))
+    if entries and gate_usable:
+        if gate["word"]:
+            gate["regex"].append(fr'[\s_-](?:{"|".join(gate["word"])})[\s_-]')
+        try:
+            return re.compile("|".join(gate["regex"] + gate["any"])), entries
+        except re.error:
+            pass
+    return None, entries
+
+
+def replace_text(text: str):
+    gate, entries = REPLACE_WORDS
+    # nothing match, so the text stays the same
+    if gate and not gate.search(text):
+        return text
+    for old, system, pattern, replacement, literal, new in entries:
+        if literal is not None and literal not in text:
+            continue
+        if pattern:
+            tmp = pattern.sub(replacement, text)
         else:
-            tmp = re.sub(fr'([\s_-])({old})([\s_-])', f'\\1{new[0]}\\3', text)
-            if tmp != text:
-                log.LogDebug(f"'{old}' changed with '{new[0]}'")
+            tmp = text.replace(old, replacement)
+        if tmp != text:
+            if system == "regex":
+                log.LogDebug("Regex matched: %s -> %s", text, tmp)
+            else:
+                log.LogDebug("'%s' changed with '%s'", old, new)
         text = tmp
-    return tmp
+    return text
 
 
 def cleanup_text(text: str):
@@ -715,7 +1215,95 @@ def remove_consecutive_nonword(text: str):
     return text
 
 
-def field_replacer(text: str, scene_information:dict):
+FIELD_REGEX = re.compile(r"\$\w+")
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(text: str):
+    """Parse a template into a list of literals and fields, None when it needs the sequential replacer."""
+    program = []
+    position = 0
+    for m in FIELD_REGEX.finditer(text):
+        field = m.group(0)[1:].strip("_")
+        # '$field_' and lone '$' depend on the order of the replacements
+        if m.group(0) != f"${field}" or "$" in text[position:m.start()]:
+            return None
+        if position < m.start():
+            program.append((None, text[position:m.start()]))
+        program.append((field, FIELD_REPLACER.get(f"${field}")))
+        position = m.end()
+    if "$" in text[position:]:
+        return None
+    if position < len(text):
+        program.append((None, text[position:]))
+    fields = {field for field, _ in program if field}
+    # $title stays in the text, a field that starts it would replace a part of it
+    if "title" in fields and any(f != "title" and "title".startswith(f) for f in fields):
+        return None
+    # a value glued to one of these fields could form another field ($t + 'itle')
+    prefixes = {f for f in fields if any(other != f and other.startswith(f) for other in fields)}
+    # the performer is removed when it's the field just before $title (by length order)
+    field_found = sorted((f"${field}" for field, _ in program if field), key=len, reverse=True)
+    performer_title = "$performer" in field_found and field_found[field_found.index("$performer") + 1:][:1] == ["$title"]
+    return program, prefixes, performer_title
+
+
+def render_template(compiled: tuple, scene_information: dict):
+    program, prefixes, performer_title = compiled
+    skip_performer = False
+    if performer_title and scene_information.get('performer') and scene_information.get('title') and PREVENT_TITLE_PERF:
+        if type(scene_information['performer']) is not str or type(scene_information['title']) is not str:
+            return None
+        if re.search(f"^{scene_information['performer'].lower()}", scene_information['title'].lower()):
+            log.LogDebug("Ignoring the performer field because it's already in start of title")
+            skip_performer = True
+    title = None
+    words = {}
+    result = []
+    glued = False
+    for field, data in program:
+        if field is None:
+            result.append(data)
+            glued = False
+            continue
+        replaced_word = words.get(field)
+        if replaced_word is None:
+            replaced_word = scene_information.get(field)
+            if not replaced_word:
+                replaced_word = ""
+            elif type(replaced_word) is not str:
+                return None
+            if data:
+                replaced_word = replaced_word.replace(data["replace"], data["with"])
+            if field == "title":
+                title = replaced_word.strip()
+                replaced_word = "$title"
+            elif field == "performer" and skip_performer:
+                replaced_word = ""
+            elif "$" in replaced_word:
+                # the value could be replaced again by the sequential replacer
+                return None
+            words[field] = replaced_word
+        if glued and re.match(r"\w", replaced_word):
+            return None
+        if field in prefixes:
+            glued = True
+        elif replaced_word:
+            glued = False
+        result.append(replaced_word)
+    return "".join(result), title
+
+
+def field_replacer(text: str, scene_information: dict):
+    compiled = compile_template(text)
+    if compiled:
+        rendered = render_template(compiled, scene_information)
+        if rendered:
+            return rendered
+    return field_replacer_sequential(text, scene_information)
+
+
+def field_replacer_sequential(text: str, scene_information: dict):
     field_found = re.findall(r"\$\w+", text)
     result = text
     title = None
@@ -858,89 +1446,806 @@ def connect_db(path: str):
     return sqliteConnection
 
 
-def checking_duplicate_db(scene_info: dict):
-    scenes = graphql_findScenebyPath(scene_info['final_path'], "EQUALS")
-    if scenes["count"] > 0:
+def rating5(rating100):
+    # the 'rating' of GraphQL, from the rating100 column of newer Stash
+    if rating100 is None:
+        return None
+    return min(5, max(1, int(rating100 / 20 + 0.5)))
+
+
+class SceneLoader:
+    """Read the scenes straight from the Stash database (read-only), in the shape findScenes gives them.
+
+    Only the fields of scene_query_fields are loaded, every relation with one query per page.
+    """
+
+    # ids per IN (...), below the SQLite limit of variables
+    CHUNK = 500
+
+    def __init__(self, path: str):
+        uri = "file:" + urllib.request.pathname2url(os.path.abspath(path)) + "?mode=ro"
+        self.db = sqlite3.connect(uri, uri=True, timeout=10)
+        self.columns = {}
+        for (table,) in self.db.execute("SELECT name FROM sqlite_master WHERE type='table'"):
+            self.columns[table] = {row[1] for row in self.db.execute(f'PRAGMA table_info("{table}")')}
+        self.refactor = DB_VERSION >= DB_VERSION_FILE_REFACTOR
+        required = {"scenes": {"id", "title", "date", "organized", "studio_id"}}
+        if self.refactor:
+            required.update({"scenes_files": {"scene_id", "file_id"}, "files": {"id", "basename", "parent_folder_id"},
+                             "folders": {"id", "path"}, "video_files": {"file_id", "duration", "video_codec", "audio_codec", "width", "height", "frame_rate", "bit_rate"},
+                             "files_fingerprints": {"file_id", "type", "fingerprint"}})
+        else:
+            required["scenes"] |= {"path", "oshash", "checksum", "duration", "video_codec", "audio_codec", "width", "height", "framerate", "bitrate"}
+        # movies are groups since Stash 0.27
+        self.movies = ("movies", "movies_scenes", "movie_id") if "movies_scenes" in self.columns else ("groups", "groups_scenes", "group_id")
+        fields = set(re.findall(r"^\s*(\w+)", scene_query_fields(CONFIG_FINGERPRINT), re.M))
+        self.fields = fields
+        self.studios = None
+        if "studio" in fields:
+            required["studios"] = {"id", "name", "parent_id"}
+        if "tags" in fields:
+            required.update({"tags": {"id", "name"}, "scenes_tags": {"scene_id", "tag_id"}})
+        if "stash_ids" in fields:
+            required["scene_stash_ids"] = {"scene_id", "endpoint", "stash_id"}
+        if "performers" in fields:
+            required.update({"performers": {"id", "name", "gender", "favorite"}, "performers_scenes": {"performer_id", "scene_id"},
+                             "performer_stash_ids": {"performer_id", "endpoint", "stash_id"}})
+        if "movies" in fields:
+            required.update({self.movies[0]: {"id", "name", "date"}, self.movies[1]: {self.movies[2], "scene_id", "scene_index"}})
+        for table, columns in required.items():
+            missing = columns - self.columns.get(table, set())
+            if missing:
+                self.db.close()
+                raise sqlite3.DatabaseError(f"unknown database layout ({table}: {', '.join(sorted(missing))})")
+
+    def rating(self, table: str, prefix=""):
+        if "rating100" in self.columns[table]:
+            return f"{prefix}rating100", rating5
+        return f"{prefix}rating", lambda rating: rating
+
+    def rows(self, sql: str, ids: list):
+        """Rows of sql, whose IN {} is filled with ids by chunk."""
+        for start in range(0, len(ids), self.CHUNK):
+            chunk = ids[start:start + self.CHUNK]
+            yield from self.db.execute(sql.format(",".join("?" * len(chunk))), chunk)
+
+    def scene_ids(self, limit: int, scene_ids=None) -> list:
+        ids = [row[0] for row in self.db.execute("SELECT id FROM scenes ORDER BY id")]
+        if scene_ids:
+            wanted = {int(i) for i in scene_ids}
+            ids = [i for i in ids if i in wanted]
+        return ids if limit < 0 else ids[:limit]
+
+    def load(self, ids: list) -> list:
+        scenes = {}
+        rating_column, rating = self.rating("scenes")
+        code = ", code" if "code" in self.columns["scenes"] else ""
+        legacy = ", path, oshash, checksum, duration, video_codec, audio_codec, width, height, framerate, bitrate" if not self.refactor else ""
+        with_rating = "rating" in self.fields
+        for row in self.rows(f"SELECT id, title, date, organized, studio_id, {rating_column}{code}{legacy} FROM scenes WHERE id IN ({{}})", ids):
+            scene = {"id": str(row[0]), "title": row[1], "date": row[2], "organized": bool(row[3])}
+            if with_rating:
+                scene["rating"] = rating(row[5])
+            extra = list(row[6:])
+            if code:
+                scene["code"] = extra.pop(0)
+            if legacy:
+                scene["path"], scene["oshash"], scene["checksum"] = extra[:3]
+                scene["file"] = dict(zip(("duration", "video_codec", "audio_codec", "width", "height", "framerate", "bitrate"), extra[3:]))
+            else:
+                scene["oshash"] = scene["checksum"] = None
+                scene["files"] = []
+            scene["_studio_id"] = row[4]
+            scenes[row[0]] = scene
+        if self.refactor:
+            self.load_files(scenes, ids)
+        if "stash_ids" in self.fields:
+            for scene in scenes.values():
+                scene["stash_ids"] = []
+            for scene_id, endpoint, stash_id in self.rows("SELECT scene_id, endpoint, stash_id FROM scene_stash_ids WHERE scene_id IN ({}) ORDER BY rowid", ids):
+                scenes[scene_id]["stash_ids"].append({"endpoint": endpoint, "stash_id": stash_id})
+        if "studio" in self.fields:
+            if self.studios is None:
+                self.studios = {i: (name, parent) for i, name, parent in self.db.execute("SELECT id, name, parent_id FROM studios")}
+            studios = self.studios
+            for scene in scenes.values():
+                studio_id = scene["_studio_id"]
+                scene["studio"] = None
+                if studio_id in studios:
+                    name, parent = studios[studio_id]
+                    scene["studio"] = {"id": str(studio_id), "name": name, "parent_studio": None}
+                    if parent in studios:
+                        scene["studio"]["parent_studio"] = {"id": str(parent), "name": studios[parent][0]}
+        if "tags" in self.fields:
+            for scene in scenes.values():
+                scene["tags"] = []
+            for scene_id, tag_id, name in self.rows("SELECT scenes_tags.scene_id, tags.id, tags.name FROM scenes_tags JOIN tags ON tags.id = scenes_tags.tag_id WHERE scenes_tags.scene_id IN ({}) ORDER BY scenes_tags.rowid", ids):
+                scenes[scene_id]["tags"].append({"id": str(tag_id), "name": name})
+        if "performers" in self.fields:
+            self.load_performers(scenes, ids)
+        if "movies" in self.fields:
+            table, join, column = self.movies
+            for scene in scenes.values():
+                scene["movies"] = []
+            for scene_id, name, date, scene_index in self.rows(
+                    f"SELECT {join}.scene_id, {table}.name, {table}.date, {join}.scene_index FROM {join} JOIN {table} ON {table}.id = {join}.{column} WHERE {join}.scene_id IN ({{}}) ORDER BY {join}.rowid", ids):
+                scenes[scene_id]["movies"].append({"movie": {"name": name, "date": date}, "scene_index": scene_index})
+        for scene in scenes.values():
+            del scene["_studio_id"]
+        return [scenes[i] for i in ids if i in scenes]
+
+    def load_files(self, scenes: dict, ids: list):
+        files = {}
+        primary = ', scenes_files."primary"' if "primary" in self.columns["scenes_files"] else ", 0"
+        for scene_id, file_id, folder, basename, is_primary, duration, video_codec, audio_codec, width, height, frame_rate, bit_rate in self.rows(
+                f"SELECT scenes_files.scene_id, files.id, folders.path, files.basename{primary}, video_files.duration, video_files.video_codec, "
+                "video_files.audio_codec, video_files.width, video_files.height, video_files.frame_rate, video_files.bit_rate "
+                "FROM scenes_files JOIN files ON files.id = scenes_files.file_id JOIN folders ON folders.id = files.parent_folder_id "
+                "LEFT JOIN video_files ON video_files.file_id = files.id WHERE scenes_files.scene_id IN ({}) ORDER BY scenes_files.scene_id, files.id", ids):
+            scene_file = {"path": os.path.join(folder, basename), "video_codec": video_codec, "audio_codec": audio_codec, "width": width,
+                          "height": height, "frame_rate": frame_rate, "duration": duration, "bit_rate": bit_rate, "fingerprints": []}
+            files[file_id] = scene_file
+            # the primary file first, like Stash
+            if is_primary:
+                scenes[scene_id]["files"].insert(0, scene_file)
+            else:
+                scenes[scene_id]["files"].append(scene_file)
+        for file_id, fingerprint_type, value in self.rows("SELECT file_id, type, fingerprint FROM files_fingerprints WHERE file_id IN ({})", list(files)):
+            if isinstance(value, bytes):
+                value = value.decode(errors="replace")
+            files[file_id]["fingerprints"].append({"type": fingerprint_type, "value": str(value)})
+        for scene in scenes.values():
+            if scene["files"]:
+                for fingerprint in scene["files"][0]["fingerprints"]:
+                    if fingerprint["type"] == "oshash":
+                        scene["oshash"] = fingerprint["value"]
+                    elif fingerprint["type"] == "md5":
+                        scene["checksum"] = fingerprint["value"]
+
+    def load_performers(self, scenes: dict, ids: list):
+        rating_column, rating = self.rating("performers", "performers.")
+        performers = {}
+        scene_performers = []
+        for scene_id, performer_id, name, gender, favorite, performer_rating in self.rows(
+                f"SELECT performers_scenes.scene_id, performers.id, performers.name, performers.gender, performers.favorite, {rating_column} "
+                "FROM performers_scenes JOIN performers ON performers.id = performers_scenes.performer_id "
+                "WHERE performers_scenes.scene_id IN ({}) ORDER BY performers_scenes.rowid", ids):
+            if performer_id not in performers:
+                performers[performer_id] = {"id": str(performer_id), "name": name, "gender": gender, "favorite": bool(favorite),
+                                            "rating": rating(performer_rating), "stash_ids": []}
+            scene_performers.append((scene_id, performer_id))
+        for performer_id, endpoint, stash_id in self.rows("SELECT performer_id, endpoint, stash_id FROM performer_stash_ids WHERE performer_id IN ({}) ORDER BY rowid", list(performers)):
+            performers[performer_id]["stash_ids"].append({"endpoint": endpoint, "stash_id": stash_id})
+        for scene in scenes.values():
+            scene["performers"] = []
+        for scene_id, performer_id in scene_performers:
+            # a copy for each scene, extract_info can change the name
+            scenes[scene_id]["performers"].append(dict(performers[performer_id]))
+
+    def pages(self, limit: int, page_size: int, scene_ids=None):
+        """Yield (total, scenes) like graphql_findScenePages, Stash is asked for the rest if the database can't be read anymore."""
+        try:
+            ids = self.scene_ids(limit, scene_ids)
+            total = len(ids)
+            if page_size <= 0:
+                page_size = max(total, 1)
+            for start in range(0, max(total, 1), page_size):
+                page = ids[start:start + page_size]
+                try:
+                    scenes = self.load(page)
+                except sqlite3.Error as err:
+                    log.LogWarning(f"Can't read the scenes in the database anymore ({err}), asking Stash")
+                    # only the ids of the page in each request, the list of the library would be sent every time
+                    for rest in range(start, total, page_size):
+                        page = ids[rest:rest + page_size]
+                        yield total, graphql_findScene(len(page), "ASC", 1, "id", page)["scenes"]
+                    return
+                yield total, scenes
+        finally:
+            self.db.close()
+
+
+def scene_pages(limit: int, page_size: int, scene_ids=None):
+    """Pages of scenes for the task renamer: from the database with bulk_read_db, from Stash otherwise or if it fails."""
+    if config.bulk_read_db:
+        try:
+            return SceneLoader(STASH_DATABASE).pages(limit, page_size, scene_ids)
+        except sqlite3.Error as err:
+            log.LogWarning(f"Can't read the scenes in the database ({err}), asking Stash")
+    return graphql_findScenePages(limit, page_size, "ASC", scene_ids)
+
+
+class PathIndex:
+    """Path and filename of every scene file, to check collisions without asking Stash."""
+
+    def __init__(self, stash_db: sqlite3.Connection):
+        self.paths = {}
+        self.filenames = {}
+        cursor = stash_db.cursor()
+        if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            cursor.execute("SELECT scenes_files.scene_id, folders.path, files.basename FROM scenes_files JOIN files ON files.id = scenes_files.file_id JOIN folders ON folders.id = files.parent_folder_id")
+            for scene_id, folder, basename in cursor:
+                self.add(scene_id, os.path.join(folder, basename))
+        else:
+            cursor.execute("SELECT id, path FROM scenes")
+            for scene_id, path in cursor:
+                self.add(scene_id, path)
+        cursor.close()
+        log.LogDebug(f"[Duplicate] {len(self.paths)} paths indexed")
+
+    @staticmethod
+    def _insert(index: dict, key: str, scene_id: str):
+        ids = index.get(key, ())
+        if scene_id not in ids:
+            index[key] = ids + (scene_id,)
+
+    @staticmethod
+    def _remove(index: dict, key: str, scene_id: str):
+        ids = tuple(x for x in index.get(key, ()) if x != scene_id)
+        if ids:
+            index[key] = ids
+        else:
+            index.pop(key, None)
+
+    def add(self, scene_id, path: str):
+        self._insert(self.paths, os.path.normcase(path), str(scene_id))
+        self._insert(self.filenames, os.path.normcase(os.path.basename(path)), str(scene_id))
+
+    def remove(self, scene_id, path: str):
+        self._remove(self.paths, os.path.normcase(path), str(scene_id))
+        self._remove(self.filenames, os.path.normcase(os.path.basename(path)), str(scene_id))
+
+    def scenes_by_path(self, path: str) -> tuple:
+        return self.paths.get(os.path.normcase(path), ())
+
+    def scenes_by_filename(self, filename: str) -> tuple:
+        return self.filenames.get(os.path.normcase(filename), ())
+
+
+def checking_duplicate_db(scene_info: dict, path_index=None):
+    if path_index is not None:
+        scenes = path_index.scenes_by_path(scene_info['final_path'])
+    else:
+        scenes = [x['id'] for x in graphql_findScenebyPath(scene_info['final_path'], "EQUALS")["scenes"]]
+    if scenes:
         log.LogError("Duplicate path detected")
-        for dupl_row in scenes["scenes"]:
-            log.LogWarning(f"Identical path: [{dupl_row['id']}]")
+        for dupl_id in scenes:
+            log.LogWarning(f"Identical path: [{dupl_id}]")
         return 1
-    scenes = graphql_findScenebyPath(scene_info['new_filename'], "EQUALS")
-    if scenes["count"] > 0:
-        for dupl_row in scenes["scenes"]:
-            if dupl_row['id'] != scene_info['scene_id']:
-                log.LogWarning(f"Duplicate filename: [{dupl_row['id']}]")
+    if path_index is not None:
+        scenes = path_index.scenes_by_filename(scene_info['new_filename'])
+    else:
+        scenes = [x['id'] for x in graphql_findScenebyPath(scene_info['new_filename'], "EQUALS")["scenes"]]
+    for dupl_id in scenes:
+        if dupl_id != scene_info['scene_id']:
+            log.LogWarning(f"Duplicate filename: [{dupl_id}]")
 
 
 def db_rename(stash_db: sqlite3.Connection, scene_info):
     cursor = stash_db.cursor()
     # Database rename
     cursor.execute("UPDATE scenes SET path=? WHERE id=?;", [scene_info['final_path'], scene_info['scene_id']])
-    stash_db.commit()
-    # Close DB
     cursor.close()
 
 
-def db_rename_refactor(stash_db: sqlite3.Connection, scene_info):
+class FolderCache:
+    """path -> id of the Stash folders, updated in memory when folders are created.
+
+    The scanner of Stash can add, move or delete folders between our transactions: a
+    path missing from the cache is looked up in the database, and a cached id is checked
+    against the database the first time it is used in a transaction.
+    Ids of new folders come from one allocator, read under the write lock once per transaction.
+    """
+
+    def __init__(self, stash_db: sqlite3.Connection, preload=False):
+        self.db = stash_db
+        self.ids = {}
+        self.next_id = None
+        # paths inserted in the running transaction, forgotten if it is rolled back
+        self.created = []
+        # paths whose id was read/checked in the running transaction
+        self.checked = set()
+        if preload:
+            cursor = stash_db.cursor()
+            cursor.execute("SELECT id, path FROM folders")
+            self.ids = {path: folder_id for folder_id, path in cursor}
+            cursor.close()
+            log.LogDebug(f"[SQLITE] {len(self.ids)} folders loaded")
+
+    def get(self, path: str):
+        folder_id = self.ids.get(path)
+        if path in self.checked:
+            return folder_id
+        cursor = self.db.cursor()
+        if folder_id is not None:
+            cursor.execute("SELECT path FROM folders WHERE id=?", [folder_id])
+            row = cursor.fetchone()
+            if row is None or row[0] != path:
+                folder_id = None
+        if folder_id is None:
+            cursor.execute("SELECT id FROM folders WHERE path=?", [path])
+            row = cursor.fetchone()
+            if row:
+                folder_id = row[0]
+        cursor.close()
+        if folder_id is None:
+            self.ids.pop(path, None)
+        else:
+            self.ids[path] = folder_id
+            self.checked.add(path)
+        return folder_id
+
+    def create(self, path: str, mod_time: str):
+        """Return the id of the folder, creating it and its missing parents in one insert."""
+        folder_id = self.get(path)
+        if folder_id is not None:
+            return folder_id
+        # reduce the path to find a parent folder
+        missing = [path]
+        parent_id = None
+        parent = os.path.dirname(path)
+        while parent != missing[-1]:
+            parent_id = self.get(parent)
+            if parent_id is not None:
+                break
+            missing.append(parent)
+            parent = os.path.dirname(parent)
+        if parent_id is None:
+            return None
+        cursor = self.db.cursor()
+        if self.next_id is None:
+            # folders uses AUTOINCREMENT, never reuse an id even if the row was deleted
+            cursor.execute("SELECT MAX(id) FROM folders")
+            last_id = cursor.fetchone()[0] or 0
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name='folders'")
+            seq = cursor.fetchone()
+            self.next_id = max(last_id, seq[0] if seq else 0) + 1
+        rows = []
+        for folder in reversed(missing):
+            rows.append([self.next_id, folder, parent_id, mod_time, mod_time, mod_time, None])
+            parent_id = self.next_id
+            self.next_id += 1
+        cursor.executemany(
+            "INSERT INTO 'main'.'folders'('id', 'path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?, ?);",
+            rows)
+        cursor.close()
+        for row in rows:
+            self.ids[row[1]] = row[0]
+            self.checked.add(row[1])
+            self.created.append(row[1])
+        log.LogDebug(f"[SQLITE] Created {len(rows)} folder(s) ({path})")
+        return parent_id
+
+    def savepoint(self) -> int:
+        return len(self.created)
+
+    def rollback(self, mark=0):
+        for path in self.created[mark:]:
+            self.ids.pop(path, None)
+            self.checked.discard(path)
+        del self.created[mark:]
+        if mark == 0:
+            self.next_id = None
+            self.checked = set()
+
+    def commit(self):
+        self.created = []
+        # the scanner of Stash can change the folders between our transactions
+        self.next_id = None
+        self.checked = set()
+
+
+def db_rename_refactor(stash_db: sqlite3.Connection, scene_info, folders: FolderCache):
     cursor = stash_db.cursor()
     # 2022-09-17T11:25:52+02:00
     mod_time = datetime.now().astimezone().isoformat('T', 'seconds')
 
-    # get the next id that we should use if needed
-    cursor.execute("SELECT MAX(id) from folders")
-    new_id = cursor.fetchall()[0][0] + 1
-
     # get the old folder id
-    cursor.execute("SELECT id FROM folders WHERE path=?", [scene_info['current_directory']])
-    old_folder_id = cursor.fetchall()[0][0]
-
-    # check if the folder of file is created in db
-    cursor.execute("SELECT id FROM folders WHERE path=?", [scene_info['new_directory']])
-    folder_id = cursor.fetchall()
-    if not folder_id:
-        dir = scene_info['new_directory']
-        # reduce the path to find a parent folder
-        for _ in range(1, len(scene_info['new_directory'].split(os.sep))):
-            dir = os.path.dirname(dir)
-            cursor.execute("SELECT id FROM folders WHERE path=?", [dir])
-            parent_id = cursor.fetchall()
-            if parent_id:
-                # create a new row with the new folder with the parent folder find above
-                cursor.execute(
-                    "INSERT INTO 'main'.'folders'('id', 'path', 'parent_folder_id', 'mod_time', 'created_at', 'updated_at', 'zip_file_id') VALUES (?, ?, ?, ?, ?, ?, ?);",
-                    [
-                        new_id, scene_info['new_directory'], parent_id[0][0],
-                        mod_time, mod_time, mod_time, None
-                    ])
-                stash_db.commit()
-                folder_id = new_id
-                break
-    else:
-        folder_id = folder_id[0][0]
+    old_folder_id = folders.get(scene_info['current_directory'])
+    if old_folder_id is None:
+        cursor.close()
+        raise Exception(f"Failed to find the folder of the file ({scene_info['current_directory']})")
+
+    # check if the folder of file is created in db, create it with its missing parents if needed
+    folder_id = folders.create(scene_info['new_directory'], mod_time)
     if folder_id:
-        cursor.execute("SELECT file_id from scenes_files WHERE scene_id=?", [scene_info['scene_id']])
-        file_ids = cursor.fetchall()
-        file_id = None
-        for f in file_ids:
-            # it can have multiple file for a scene
-            cursor.execute("SELECT parent_folder_id from files WHERE id=?", [f[0]])
-            check_parent = cursor.fetchall()[0][0]
-            # if the parent id is the one found above section, we find our file.s
-            if check_parent == old_folder_id:
-                file_id = f[0]
-                break
+        # it can have multiple file for a scene
+        cursor.execute(
+            "SELECT files.id FROM scenes_files JOIN files ON files.id = scenes_files.file_id WHERE scenes_files.scene_id=? AND files.parent_folder_id=? AND files.basename=?",
+            [scene_info['scene_id'], old_folder_id, scene_info['current_filename']])
+        file_id = cursor.fetchone()
         if file_id:
             #log.LogDebug(f"UPDATE files SET basename={scene_info['new_filename']}, parent_folder_id={folder_id}, updated_at={mod_time} WHERE id={file_id};")
-            cursor.execute("UPDATE files SET basename=?, parent_folder_id=?, updated_at=? WHERE id=?;", [scene_info['new_filename'], folder_id, mod_time, file_id])
+            cursor.execute("UPDATE files SET basename=?, parent_folder_id=?, updated_at=? WHERE id=?;", [scene_info['new_filename'], folder_id, mod_time, file_id[0]])
             cursor.close()
-            stash_db.commit()
         else:
+            cursor.close()
             raise Exception("Failed to find file_id")
     else:
         cursor.close()
         raise Exception(f"You need to setup a library with the new location ({scene_info['new_directory']}) and scan at least 1 file")
 
 
+class DatabaseWriter:
+    """Save renamed scenes in the database by batch, every scene in its own savepoint.
+
+    The files are already moved when a scene is added. If its update fails, only this
+    scene is rolled back and its files are moved back. If the whole transaction fails,
+    the files of every scene of the batch are moved back.
+    """
+
+    def __init__(self, stash_db: sqlite3.Connection, batch_size=1, batch_time=0, path_index=None, preload_folders=False):
+        # transactions are handled here
+        stash_db.isolation_level = None
+        self.db = stash_db
+        self.folders = None
+        if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
+            self.folders = FolderCache(stash_db, preload_folders)
+        self.batch_size = batch_size
+        self.batch_time = batch_time / 1000
+        self.path_index = path_index
+        self.pending = []
+        self.started = 0
+        self.saved = 0
+        self.commits = 0
+        self.commit_total = 0
+        self.commit_max = 0
+        # scenes that couldn't be renamed, tried again by the next incremental run
+        self.failed = set()
+
+    def add(self, scene_info: dict):
+        if not self.pending:
+            self.started = time.perf_counter()
+        self.pending.append(scene_info)
+        self.tick()
+
+    def tick(self):
+        if self.pending and (len(self.pending) >= self.batch_size or time.perf_counter() - self.started >= self.batch_time):
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        saved = []
+        reverted = set()
+        cursor = self.db.cursor()
+        try:
+            # the moves of the batch must be on disk in the journal before the database knows them
+            if RENAME_JOURNAL:
+                RENAME_JOURNAL.sync()
+            # take the write lock now, a deferred transaction can fail when it upgrades from read to write
+            cursor.execute("BEGIN IMMEDIATE")
+            for scene_info in pending:
+                cursor.execute("SAVEPOINT scene")
+                try:
+                    if self.folders:
+                        mark = self.folders.savepoint()
+                        db_rename_refactor(self.db, scene_info, self.folders)
+                    else:
+                        db_rename(self.db, scene_info)
+                except Exception as err:
+                    cursor.execute("ROLLBACK TO scene")
+                    cursor.execute("RELEASE scene")
+                    if self.folders:
+                        self.folders.rollback(mark)
+                    log.LogError(f"[{scene_info['scene_id']}] error when trying to update the database ({err}), revert the move...")
+                    self.revert(scene_info)
+                    reverted.add(id(scene_info))
+                    continue
+                cursor.execute("RELEASE scene")
+                saved.append(scene_info)
+            start = time.perf_counter()
+            cursor.execute("COMMIT")
+            elapsed = time.perf_counter() - start
+            self.commits += 1
+            self.commit_total += elapsed
+            self.commit_max = max(self.commit_max, elapsed)
+            if PHASE_STATS:
+                PHASE_STATS.record("sqlite_commit", elapsed)
+        except (sqlite3.Error, OSError) as err:
+            if self.db.in_transaction:
+                self.db.rollback()
+            if self.folders:
+                self.folders.rollback()
+            log.LogError(f"[SQLITE] Failed to save {len(pending)} scene(s) ({err}), revert the moves...")
+            for scene_info in reversed(pending):
+                if id(scene_info) not in reverted:
+                    self.revert(scene_info)
+            return
+        finally:
+            cursor.close()
+        if self.folders:
+            self.folders.commit()
+        self.saved += len(saved)
+        clean_tags = {}
+        for scene_info in saved:
+            if self.path_index is not None:
+                self.path_index.remove(scene_info['scene_id'], scene_info['current_path'])
+            if scene_info.get("clean_tag"):
+                clean_tags.setdefault(tuple(scene_info["clean_tag"]), set()).add(scene_info['scene_id'])
+        for id_tags, id_scenes in clean_tags.items():
+            try:
+                graphql_removeScenesTag(sorted(id_scenes), list(id_tags))
+            except Exception as err:
+                log.LogError(f"Failed to remove the tag(s) {list(id_tags)} ({err})")
+
+    def revert(self, scene_info: dict):
+        self.failed.add(int(scene_info['scene_id']))
+        revert_rename(scene_info)
+        if self.path_index is not None:
+            self.path_index.remove(scene_info['scene_id'], scene_info['final_path'])
+
+    def close(self):
+        self.flush()
+        if self.commits:
+            log.LogDebug(f"[SQLITE] {self.saved} scene(s) saved in {self.commits} transaction(s), commit latency: avg {round(self.commit_total / self.commits * 1000, 2)}ms, max {round(self.commit_max * 1000, 2)}ms")
+
+
+class FolderSweeper:
+    """Folders left by the moves, removed once the moves are done if they are empty.
+
+    The deepest folders are checked first, so a parent emptied by the removal of its
+    subfolders is removed too, up to the library root (never removed). Files named in
+    ``ignored`` (e.g. .DS_Store) don't keep a folder, they are deleted with it.
+    """
+
+    def __init__(self, roots=(), ignored=(), batch_size=100):
+        self.roots = {os.path.normcase(os.path.normpath(root)) for root in roots}
+        self.ignored = {name.lower() for name in ignored}
+        self.batch_size = max(1, batch_size)
+        self.folders = set()
+
+    def add(self, folder: str):
+        self.folders.add(os.path.normpath(folder))
+
+    def in_library(self, folder: str) -> bool:
+        """``folder`` is inside a library root (and isn't the root itself)."""
+        folder = os.path.normcase(folder)
+        return any(folder.startswith(os.path.join(root, "")) for root in self.roots)
+
+    def remove(self, folder: str) -> bool:
+        if os.path.normcase(folder) in self.roots:
+            return False
+        try:
+            with os.scandir(folder) as it:
+                entries = list(it)
+        except FileNotFoundError:
+            return False
+        except OSError as err:
+            log.LogWarning(f"Fail to check the folder {folder} - {err}")
+            return False
+        if any(not entry.is_file(follow_symlinks=False) or entry.name.lower() not in self.ignored for entry in entries):
+            return False
+        log.LogInfo(f"Removing empty folder ({folder})")
+        try:
+            for entry in entries:
+                os.remove(entry.path)
+            os.rmdir(folder)
+        except OSError as err:
+            log.LogWarning(f"Fail to delete empty folder {folder} - {err}")
+            return False
+        return True
+
+    def sweep(self, pool=None):
+        """Remove the empty folders, depth by depth, each depth by batch of ``batch_size`` folders (checked in ``pool`` if given)."""
+        folders, self.folders = self.folders, set()
+        while folders:
+            depth = max(folder.count(os.sep) for folder in folders)
+            level = sorted(folder for folder in folders if folder.count(os.sep) == depth)
+            folders.difference_update(level)
+            for start in range(0, len(level), self.batch_size):
+                batch = level[start:start + self.batch_size]
+                removed = pool.map(self.remove, batch) if pool else map(self.remove, batch)
+                for folder, ok in zip(batch, removed):
+                    # the parent of a folder outside the libraries isn't touched
+                    if ok and self.in_library(folder):
+                        folders.add(os.path.dirname(folder))
+
+
+def remove_empty_folder(folder: str):
+    # other moves can still be using this folder, it's checked at the end
+    DEFERRED_FOLDERS.add(folder)
+
+
+def compute_oshash(path: str) -> str:
+    # same hash as Stash: size + sum of the 64-bit words of the first and last 64KiB
+    size = os.path.getsize(path)
+    if size == 0:
+        return ""
+    chunk = min(size, 65536)
+    with open(path, 'rb') as f:
+        data = f.read(chunk)
+        f.seek(-chunk, os.SEEK_END)
+        data += f.read(chunk)
+    count = len(data) // 8
+    return f"{(sum(struct.unpack(f'<{count}Q', data[:count * 8])) + size) & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def copy_file_data(fsrc, fdst, position: int, size: int, name: str, synced=None):
+    # copy from position to the end, kernel offload when possible, else large buffers.
+    # Every MOVE_SYNC_SIZE bytes the copy is fsynced and synced(position) is called.
+    last_log = time.time()
+    start = last_sync = position
+    start_time = last_log
+
+    def progress():
+        nonlocal last_log, last_sync
+        if synced and position - last_sync >= MOVE_SYNC_SIZE:
+            fdst.flush()
+            os.fsync(out_fd)
+            last_sync = position
+            synced(position)
+        if time.time() - last_log >= MOVE_PROGRESS_INTERVAL:
+            last_log = time.time()
+            speed = (position - start) / (last_log - start_time) / 1048576
+            log.LogDebug(f"[OS] Copying {name}: {round(position / size * 100)}% ({round(speed, 1)} MB/s)")
+            log.flush()
+
+    in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+    if hasattr(os, "copy_file_range"):
+        try:
+            while position < size:
+                copied = os.copy_file_range(in_fd, out_fd, min(size - position, MOVE_BUFFER_SIZE), position, position)
+                if copied == 0:
+                    break
+                position += copied
+                progress()
+        except OSError:
+            # not supported between these filesystems
+            pass
+    if position < size and sys.platform.startswith("linux"):
+        try:
+            os.lseek(out_fd, position, os.SEEK_SET)
+            while position < size:
+                copied = os.sendfile(out_fd, in_fd, position, min(size - position, MOVE_BUFFER_SIZE))
+                if copied == 0:
+                    break
+                position += copied
+                progress()
+        except OSError:
+            pass
+    if position < size:
+        fsrc.seek(position)
+        fdst.seek(position)
+        buffer = memoryview(bytearray(MOVE_BUFFER_SIZE))
+        while position < size:
+            read = fsrc.readinto(buffer)
+            if not read:
+                break
+            fdst.write(buffer[:read])
+            position += read
+            progress()
+    return position
+
+
+def same_content(path1: str, path2: str) -> bool:
+    # compare the whole files
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        while True:
+            data = f1.read(MOVE_BUFFER_SIZE)
+            if data != f2.read(MOVE_BUFFER_SIZE):
+                return False
+            if not data:
+                return True
+
+
+def move_file(current_path: str, new_path: str):
+    """Move a file, with a resumable and verified copy when it goes to another filesystem."""
+    try:
+        os.rename(current_path, new_path)
+        return
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+    # the copy goes to a temporary file first, it is resumed if the plugin was stopped during the copy
+    partial_path = new_path + ".renamerpart"
+    # identity of the source of the partial copy, it's only resumed from the same file, and
+    # the size of the copy known to be on the disk ('synced'), the rest may not have been written
+    source_path = partial_path + ".source"
+    st = os.stat(current_path)
+    size = st.st_size
+    source = {"path": current_path, "size": size, "mtime_ns": st.st_mtime_ns, "oshash": compute_oshash(current_path)}
+
+    def save_source(synced: int):
+        with open(source_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(dict(source, synced=synced), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(source_path + ".tmp", source_path)
+
+    for attempt in range(2):
+        position = 0
+        if os.path.isfile(partial_path):
+            try:
+                with open(source_path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                synced = saved.pop("synced", 0) if isinstance(saved, dict) else 0
+                position = synced if saved == source else 0
+            except (OSError, ValueError):
+                position = 0
+            if not isinstance(position, int) or position < 0 or position > min(size, os.path.getsize(partial_path)):
+                position = 0
+            if position:
+                log.LogInfo(f"[OS] Resuming the copy of {os.path.basename(current_path)} at {round(position / size * 100)}%")
+            else:
+                log.LogDebug(f"[OS] Nothing to resume in {partial_path}, copying {current_path} again")
+        resumed = position > 0
+        if not position:
+            save_source(0)
+        # the copy can take minutes, show the messages before it
+        log.flush()
+        with open(current_path, 'rb') as fsrc, open(partial_path, 'r+b' if position else 'wb') as fdst:
+            fdst.truncate(position)
+            copied = copy_file_data(fsrc, fdst, position, size, os.path.basename(current_path), save_source)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        # the oshash only reads the start and the end: a resumed copy is compared entirely
+        if copied == size and compute_oshash(partial_path) == source["oshash"] and \
+                (not resumed or same_content(current_path, partial_path)):
+            break
+        log.LogWarning(f"[OS] The copy of {current_path} doesn't match the original, copying it again")
+        os.remove(partial_path)
+    else:
+        os.remove(source_path)
+        raise OSError(f"Failed to copy {current_path} to {new_path}")
+    shutil.copystat(current_path, partial_path)
+    os.replace(partial_path, new_path)
+    os.remove(source_path)
+    os.remove(current_path)
+
+
+class RenameJournal:
+    """Append-only file of the renames (log_file), opened once and kept open.
+
+    Each record reaches the OS as soon as it is written, so it survives a crash of the
+    plugin. fsync is done at most every sync_interval milliseconds and before each commit
+    in the Stash database, the database never points to a move the journal could lose.
+    """
+
+    def __init__(self, path: str, sync_interval=None):
+        self.path = path
+        # None = never fsync (dry-run file)
+        self.sync_interval = sync_interval / 1000 if sync_interval is not None else None
+        self.file = None
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.synced = 0
+
+    def write(self, line: str):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.dirty = True
+            if self.sync_interval is not None and time.monotonic() - self.synced >= self.sync_interval:
+                self._sync()
+
+    def record(self, scene_id, current_path: str, new_path: str, oshash=""):
+        # scene_id|old path|new path|oshash (empty for associated files)|time
+        self.write(f"{scene_id}|{current_path}|{new_path}|{oshash}|{datetime.now().isoformat(timespec='seconds')}")
+
+    def _sync(self):
+        if self.dirty:
+            os.fsync(self.file.fileno())
+            self.dirty = False
+        self.synced = time.monotonic()
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None and self.sync_interval is not None:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                if self.sync_interval is not None:
+                    self._sync()
+                self.file.close()
+                self.file = None
+
+
 def file_rename(current_path: str, new_path: str, scene_info: dict):
     # OS Rename
     if not os.path.isfile(current_path):
@@ -951,11 +2256,11 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
     current_dir = os.path.dirname(current_path)
     if not os.path.exists(new_dir):
         log.LogInfo(f"Creating folder because it don't exist ({new_dir})")
-        os.makedirs(new_dir)
+        os.makedirs(new_dir, exist_ok=True)
     try:
-        shutil.move(current_path, new_path)
-    except PermissionError as err:
-        if "[WinError 32]" in str(err) and MODULE_PSUTIL:
+        move_file(current_path, new_path)
+    except OSError as err:
+        if file_in_use(err) and MODULE_PSUTIL:
             log.LogWarning("A process is using this file (Probably FFMPEG), trying to find it ...")
             # Find which process accesses the file, it's ffmpeg for sure...
             process_use = has_handle(current_path, PROCESS_ALLRESULT)
@@ -963,79 +2268,483 @@ def file_rename(current_path: str, new_path: str, scene_info: dict):
                 # Terminate the process then try again to rename
                 log.LogDebug(f"Process that uses this file: {process_use}")
                 if PROCESS_KILL:
-                    p = psutil.Process(process_use.pid)
-                    p.terminate()
-                    p.wait(10)
+                    if type(process_use) is not list:
+                        process_use = [process_use]
+                    for p in process_use:
+                        try:
+                            p.terminate()
+                        except psutil.Error:
+                            pass
+                    psutil.wait_procs(process_use, timeout=10)
+                    OPEN_FILES.invalidate()
                     # If process is not terminated, this will create an error again.
                     try:
-                        shutil.move(current_path, new_path)
+                        move_file(current_path, new_path)
                     except Exception as err:
                         log.LogError(f"Something still prevents renaming the file. {err}")
                         return 1
                 else:
                     log.LogError("A process prevents renaming the file.")
                     return 1
+            else:
+                log.LogError(f"Something prevents renaming the file. {err}")
+                return 1
+        elif isinstance(err, PermissionError) and not file_in_use(err):
+            log.LogError(f"[OS] Permission denied, can't rename the file. {err}")
+            return 1
         else:
             log.LogError(f"Something prevents renaming the file. {err}")
             return 1
     # checking if the move/rename work correctly
     if os.path.isfile(new_path):
-        log.LogInfo(f"[OS] File Renamed! ({current_path} -> {new_path})")
-        if LOGFILE:
+        log.LogInfo("[OS] File Renamed! (%s -> %s)", current_path, new_path)
+        if RENAME_JOURNAL:
             try:
-                with open(LOGFILE, 'a', encoding='utf-8') as f:
-                    f.write(f"{scene_info['scene_id']}|{current_path}|{new_path}|{scene_info['oshash']}\n")
+                RENAME_JOURNAL.record(scene_info['scene_id'], current_path, new_path, scene_info['oshash'])
             except Exception as err:
-                shutil.move(new_path, current_path)
+                move_file(new_path, current_path)
                 log.LogError(f"Restoring the original path, error writing the logfile: {err}")
                 return 1
         if REMOVE_EMPTY_FOLDER:
-            with os.scandir(current_dir) as it:
-                if not any(it):
-                    log.LogInfo(f"Removing empty folder ({current_dir})")
-                    try:
-                        os.rmdir(current_dir)
-                    except Exception as err:
-                        log.logWarning(f"Fail to delete empty folder {current_dir} - {err}")
+            remove_empty_folder(current_dir)
     else:
         # I don't think it's possible.
         log.LogError(f"[OS] Failed to rename the file ? {new_path}")
         return 1
 
+def associated_files(scene_info: dict) -> list:
+    """(current path, new path) of the associated files of the scene that exist."""
+    pairs = []
+    for ext in ASSOCIATED_EXT or []:
+        p = os.path.splitext(scene_info['current_path'])[0] + "." + ext
+        if os.path.isfile(p):
+            pairs.append([p, os.path.splitext(scene_info['final_path'])[0] + "." + ext])
+    return pairs
+
+
 def associated_rename(scene_info: dict):
-    if ASSOCIATED_EXT:
-        for ext in ASSOCIATED_EXT:
-            p = os.path.splitext(scene_info['current_path'])[0] + "." + ext
-            p_new = os.path.splitext(scene_info['final_path'])[0] + "." + ext
-            if os.path.isfile(p):
+    # a plan gives the files that were reviewed, nothing else is moved
+    pairs = scene_info.pop('planned_associated', None)
+    if pairs is None:
+        pairs = associated_files(scene_info)
+    scene_info['associated'] = []
+    for p, p_new in pairs:
+        if os.path.isfile(p):
+            try:
+                move_file(p, p_new)
+            except Exception as err:
+                log.LogError(f"Something prevents renaming this file '{p}' - err: {err}")
+                continue
+            scene_info['associated'].append((p, p_new))
+        if os.path.isfile(p_new):
+            log.LogInfo("[OS] Associate file renamed (%s)", p_new)
+            if RENAME_JOURNAL:
                 try:
-                    shutil.move(p, p_new)
+                    RENAME_JOURNAL.record(scene_info['scene_id'], p, p_new)
                 except Exception as err:
-                    log.LogError(f"Something prevents renaming this file '{p}' - err: {err}")
-                    continue
-            if os.path.isfile(p_new):
-                log.LogInfo(f"[OS] Associate file renamed ({p_new})")
-                if LOGFILE:
-                    try:
-                        with open(LOGFILE, 'a', encoding='utf-8') as f:
-                            f.write(f"{scene_info['scene_id']}|{p}|{p_new}\n")
-                    except Exception as err:
-                        shutil.move(p_new, p)
-                        log.LogError(f"Restoring the original name, error writing the logfile: {err}")
+                    move_file(p_new, p)
+                    log.LogError(f"Restoring the original name, error writing the logfile: {err}")
 
 
-def renamer(scene_id, db_conn=None):
-    option_dryrun = False
-    if type(scene_id) is dict:
-        stash_scene = scene_id
-        scene_id = stash_scene['id']
-    elif type(scene_id) is int:
-        stash_scene = graphql_getScene(scene_id)
+def revert_rename(scene_info: dict):
+    # move back the files of a scene that couldn't be saved in the database
+    for p, p_new in scene_info.get('associated', []):
+        try:
+            move_file(p_new, p)
+        except Exception as err:
+            log.LogError(f"Something prevents restoring this file '{p_new}' - err: {err}")
+    # the video last, so the folder is empty if it has to be removed
+    return file_rename(scene_info['final_path'], scene_info['current_path'], scene_info)
 
-    if config.only_organized and not stash_scene['organized'] and not PATH_NON_ORGANIZED:
-        log.LogDebug(f"[{scene_id}] Scene ignored (not organized)")
+
+def move_scene(scene_info: dict):
+    try:
+        # rename file on your disk
+        err = file_rename(scene_info['current_path'], scene_info['final_path'], scene_info)
+        if not err and scene_info.get('rename_associated'):
+            associated_rename(scene_info)
+    except Exception as err:
+        log.LogError(f"[OS] Failed to move the file ({err})")
+        return 1
+    return err
+
+
+def moved_scene(scene_info: dict, err, db_writer, path_index=None):
+    if err:
+        if path_index is not None:
+            path_index.remove(scene_info['scene_id'], scene_info['final_path'])
+        log.LogError("Error during database operation (rename)")
+        db_writer.failed.add(int(scene_info['scene_id']))
         return
+    # rename file on your db
+    db_writer.add(scene_info)
+
 
+class RenameExecutor:
+    """Move the files of independent scenes in a pool of threads.
+
+    The moves are collected in the order they were submitted and handed to the
+    database writer from the calling thread only.
+    """
+
+    def __init__(self, db_writer, path_index, workers: int, move=move_scene):
+        self.move = move
+        self.db_writer = db_writer
+        self.path_index = path_index
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = workers * 4
+        # (future, scene_info) for a move, (None, (total, callback)) when a scene is done
+        self.queue = deque()
+        self.done = 0
+
+    def submit(self, scene_info: dict):
+        self.queue.append((self.pool.submit(self.move, scene_info), scene_info))
+        block = len(self.queue) >= self.max_pending
+        if block:
+            # waiting for a move (a copy to another disk can be long)
+            log.flush()
+        self.collect(block=block)
+
+    def end_scene(self, total: int, done=None):
+        """Mark the end of the moves of a scene, done() is called once they are collected."""
+        self.queue.append((None, (total, done)))
+        self.collect()
+        log.flush()
+
+    def collect(self, block=False, wait_all=False):
+        while self.queue:
+            future, item = self.queue[0]
+            if future is not None and not future.done() and not block and not wait_all:
+                break
+            self.queue.popleft()
+            if future is None:
+                total, done = item
+                self.done += 1
+                log.LogProgress(self.done / total)
+                if done:
+                    done()
+                continue
+            moved_scene(item, future.result(), self.db_writer, self.path_index)
+            self.db_writer.tick()
+            block = False
+
+    def close(self):
+        log.flush()
+        self.collect(wait_all=True)
+        DEFERRED_FOLDERS.sweep(self.pool)
+        self.pool.shutdown()
+
+
+class RenderCache:
+    """Scenes that were already at their rendered path, kept between runs of the task.
+
+    A scene is skipped when its metadata (and its studio parents) didn't change and the
+    file is still at the cached path. Emptied when the config or the plugin changes.
+    """
+
+    def __init__(self, path: str, size: int, fingerprint: str):
+        self.db = sqlite3.connect(path)
+        self.size = size
+        self.hits = 0
+        self.used = []
+        self.saved = []
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS paths (scene_id INTEGER, file_index INTEGER, metadata TEXT, path TEXT, used INTEGER, PRIMARY KEY (scene_id, file_index))")
+        meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        if meta.get("config") != fingerprint:
+            if meta.get("config"):
+                log.LogDebug("[Cache] Config changed, emptying the rendered path cache")
+            self.db.execute("DELETE FROM paths")
+        # the least recently used scenes are removed first
+        self.run = int(meta.get("run", 0)) + 1
+        self.db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [("config", fingerprint), ("run", str(self.run))])
+        self.db.commit()
+
+    def metadata(self, scene: dict) -> str:
+        parents = []
+        if scene.get("studio") and scene["studio"].get("parent_studio"):
+            parents = STUDIO_INDEX.parents(scene["studio"])
+        return hashlib.sha1(json.dumps([scene, parents], sort_keys=True, default=str).encode()).hexdigest()
+
+    def check(self, scene_id, file_index: int, metadata: str, path: str) -> bool:
+        row = self.db.execute("SELECT metadata, path FROM paths WHERE scene_id = ? AND file_index = ?", (int(scene_id), file_index)).fetchone()
+        if row != (metadata, path):
+            return False
+        self.hits += 1
+        self.used.append((self.run, int(scene_id), file_index))
+        return True
+
+    def save(self, scene_id, file_index: int, metadata: str, path: str):
+        self.saved.append((int(scene_id), file_index, metadata, path, self.run))
+
+    def close(self):
+        try:
+            self.db.executemany("UPDATE paths SET used = ? WHERE scene_id = ? AND file_index = ?", self.used)
+            self.db.executemany("INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?)", self.saved)
+            count = self.db.execute("SELECT COUNT(*) FROM paths").fetchone()[0]
+            if count > self.size:
+                self.db.execute("DELETE FROM paths WHERE rowid IN (SELECT rowid FROM paths ORDER BY used LIMIT ?)", (count - self.size,))
+            self.db.commit()
+        except sqlite3.Error as err:
+            log.LogWarning(f"[Cache] Can't save the rendered path cache ({err})")
+        self.db.close()
+        log.LogDebug(f"[Cache] {self.hits} file(s) skipped, {len(self.saved)} added")
+
+
+class RenamePlan:
+    """JSON lines file with the renames found by the task 'Plan renames', done later by the task 'Apply plan'."""
+
+    KEYS = ('scene_id', 'current_path', 'final_path', 'current_directory', 'new_directory', 'current_filename', 'new_filename', 'oshash', 'rename_associated', 'clean_tag')
+
+    def __init__(self, path: str, folders=None):
+        self.path = path
+        # the previous plan stays until this one is complete
+        self.file = open(path + '.tmp', 'w', encoding='utf-8')
+        self.folders = folders
+        self.count = 0
+
+    def add(self, scene_info: dict):
+        record = {key: scene_info.get(key) for key in self.KEYS}
+        st = os.stat(scene_info['current_path'])
+        record['size'] = st.st_size
+        record['mtime'] = st.st_mtime
+        record['associated'] = associated_files(scene_info) if scene_info['rename_associated'] else []
+        if self.folders:
+            record['folder_id'] = self.folders.get(scene_info['current_directory'])
+            # None if it has to be created
+            record['new_folder_id'] = self.folders.get(scene_info['new_directory'])
+        self.file.write(json.dumps(record) + "\n")
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+        log.LogInfo(f"{self.count} rename(s) written in {self.path}")
+
+    @staticmethod
+    def read(path: str) -> list:
+        with open(path, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def plan_check(record: dict, path_index: PathIndex, folders) -> bool:
+    """Check that a rename of the plan can still be done."""
+    scene_id = str(record['scene_id'])
+    if scene_id not in path_index.scenes_by_path(record['current_path']):
+        log.LogWarning(f"[{scene_id}] The scene is not at {record['current_path']} anymore, ignored")
+        return False
+    if path_index.scenes_by_path(record['final_path']) or os.path.exists(record['final_path']):
+        log.LogError(f"[{scene_id}] Duplicate path detected ({record['final_path']}), ignored")
+        return False
+    if folders and record.get('folder_id') is not None and folders.get(record['current_directory']) != record['folder_id']:
+        log.LogWarning(f"[{scene_id}] The folder {record['current_directory']} changed in the database, ignored")
+        return False
+    try:
+        st = os.stat(record['current_path'])
+    except OSError:
+        log.LogWarning(f"[{scene_id}] File doesn't exist in your Disk/Drive ({record['current_path']}), ignored")
+        return False
+    if (st.st_size, st.st_mtime) != (record['size'], record['mtime']):
+        # only touched or really another file
+        if st.st_size != record['size'] or compute_oshash(record['current_path']) != record['oshash']:
+            log.LogWarning(f"[{scene_id}] The file changed since the plan ({record['current_path']}), ignored")
+            return False
+    return True
+
+
+def renamer_apply(plan_file: str) -> list:
+    """Do the renames of a plan file, without asking Stash for the scenes or rendering the templates again.
+
+    Return the ids of the scenes that failed.
+    """
+    try:
+        records = RenamePlan.read(plan_file)
+    except (OSError, ValueError) as err:
+        log.LogError(f"Can't read the plan {plan_file}: {err}")
+        return []
+    if not records:
+        log.LogInfo("No rename in the plan")
+        return []
+    total = len(records)
+    log.LogInfo(f"Applying {total} rename(s) from {plan_file}")
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        exit_plugin()
+    path_index = PathIndex(stash_db)
+    db_writer = DatabaseWriter(stash_db, config.db_batch_size, config.db_batch_time, path_index, preload_folders=True)
+    executor = None
+    if config.bulk_workers > 1:
+        executor = RenameExecutor(db_writer, path_index, config.bulk_workers)
+    for progress, scene_info in enumerate(records, 1):
+        if plan_check(scene_info, path_index, db_writer.folders):
+            if DRY_RUN:
+                log.LogInfo(f"[Dry-run] {scene_info['current_path']} -> {scene_info['final_path']}")
+                if DRY_RUN_JOURNAL:
+                    DRY_RUN_JOURNAL.write(f"{scene_info['scene_id']}|{scene_info['current_path']}|{scene_info['final_path']}")
+            else:
+                scene_info['planned_associated'] = scene_info.pop('associated', None) or []
+                path_index.add(scene_info['scene_id'], scene_info['final_path'])
+                if executor:
+                    executor.submit(scene_info)
+                else:
+                    moved_scene(scene_info, move_scene(scene_info), db_writer, path_index)
+        else:
+            db_writer.failed.add(int(scene_info['scene_id']))
+        db_writer.tick()
+        if executor:
+            executor.end_scene(total)
+        else:
+            log.LogProgress(progress / total)
+    if executor:
+        executor.close()
+    db_writer.close()
+    stash_db.close()
+    log.LogInfo("[SQLITE] Database closed!")
+    return sorted(db_writer.failed)
+
+
+def undo_records(log_file: str, since="", until="", scene_ids=None) -> list:
+    """Read the rename log and return the renames to undo, the last one first.
+
+    The moves of a path are followed, even by another scene (A -> B then B -> C gives C -> A),
+    a file moved back where it was is left alone. Associated files are attached to the file
+    of their scene.
+    """
+    # path now -> [scene_id, original path, oshash]
+    moves = {}
+    with open(log_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip("\n").split("|")
+            if len(fields) not in (3, 4, 5) or not fields[0].isdigit():
+                continue
+            scene_id, old, new = fields[:3]
+            oshash = fields[3] if len(fields) > 3 else ""
+            moved_time = fields[4] if len(fields) > 4 else ""
+            if scene_ids and scene_id not in scene_ids:
+                continue
+            # older lines have no time, only kept without time filter
+            if (since or until) and not moved_time:
+                continue
+            if (since and moved_time < since) or (until and moved_time >= until):
+                continue
+            previous = moves.pop(old, None)
+            if previous:
+                if previous[0] != scene_id:
+                    log.LogWarning(f"{old} was moved by the scene {previous[0]} then by the scene {scene_id}, "
+                                   f"the undo moves it back to {previous[1]} with the scene {scene_id}")
+                old = previous[1]
+                oshash = oshash or previous[2]
+            if old != new:
+                moves[new] = [scene_id, old, oshash]
+    associated = {}
+    records = []
+    for path, (scene_id, original, oshash) in reversed(list(moves.items())):
+        if oshash:
+            records.append({
+                'scene_id': scene_id, 'current_path': path, 'final_path': original,
+                'current_directory': os.path.dirname(path), 'new_directory': os.path.dirname(original),
+                'current_filename': os.path.basename(path), 'new_filename': os.path.basename(original),
+                'oshash': oshash, 'undo_associated': [],
+            })
+        else:
+            associated.setdefault((scene_id, os.path.splitext(path)[0]), []).append((path, original))
+    for record in records:
+        record['undo_associated'] = associated.get((record['scene_id'], os.path.splitext(record['current_path'])[0]), [])
+    return records
+
+
+def undo_move(scene_info: dict):
+    """move_scene of the undo: check the file is still the one that was renamed, move it back with its associated files."""
+    try:
+        if compute_oshash(scene_info['current_path']) != scene_info['oshash']:
+            log.LogWarning(f"[{scene_info['scene_id']}] {scene_info['current_path']} is not the file that was renamed (oshash), ignored")
+            return 1
+        err = file_rename(scene_info['current_path'], scene_info['final_path'], scene_info)
+        if err:
+            return err
+        scene_info['associated'] = []
+        for p, p_original in scene_info['undo_associated']:
+            if not os.path.isfile(p) or os.path.exists(p_original):
+                continue
+            try:
+                move_file(p, p_original)
+                if RENAME_JOURNAL:
+                    RENAME_JOURNAL.record(scene_info['scene_id'], p, p_original)
+            except Exception as err:
+                log.LogError(f"Something prevents moving back this file '{p}' - err: {err}")
+                continue
+            # revert_rename moves them from p_original to p
+            scene_info['associated'].append((p, p_original))
+    except Exception as err:
+        log.LogError(f"[OS] Failed to move back the file ({err})")
+        return 1
+    return 0
+
+
+def renamer_undo(preview=False) -> list:
+    """Move back the files renamed in log_file (filtered by undo_since, undo_until and undo_scene_ids).
+
+    With preview, only show what would be moved back. Return the ids of the scenes that failed.
+    """
+    if not LOGFILE:
+        log.LogError("log_file is not set, there is nothing to undo")
+        return []
+    scene_ids = {str(scene_id) for scene_id in config.undo_scene_ids or []}
+    try:
+        records = undo_records(LOGFILE, config.undo_since, config.undo_until, scene_ids)
+    except OSError as err:
+        log.LogError(f"Can't read the log {LOGFILE}: {err}")
+        return []
+    if not records:
+        log.LogInfo("No rename to undo")
+        return []
+    total = len(records)
+    log.LogInfo(f"Undoing {total} rename(s) from {LOGFILE}")
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        exit_plugin()
+    path_index = PathIndex(stash_db)
+    db_writer = DatabaseWriter(stash_db, config.db_batch_size, config.db_batch_time, path_index, preload_folders=True)
+    executor = None
+    if config.bulk_workers > 1 and not preview:
+        executor = RenameExecutor(db_writer, path_index, config.bulk_workers, move=undo_move)
+    for progress, scene_info in enumerate(records, 1):
+        scene_id = scene_info['scene_id']
+        if scene_id not in path_index.scenes_by_path(scene_info['current_path']):
+            log.LogWarning(f"[{scene_id}] The scene is not at {scene_info['current_path']} anymore, ignored")
+            db_writer.failed.add(int(scene_id))
+        elif path_index.scenes_by_path(scene_info['final_path']) or os.path.exists(scene_info['final_path']):
+            # can be freed by another undo of this run, a second run will do it
+            log.LogError(f"[{scene_id}] {scene_info['final_path']} is used, ignored")
+            db_writer.failed.add(int(scene_id))
+        elif preview or DRY_RUN:
+            if not os.path.isfile(scene_info['current_path']) or compute_oshash(scene_info['current_path']) != scene_info['oshash']:
+                log.LogWarning(f"[{scene_id}] {scene_info['current_path']} is not the file that was renamed, ignored")
+            else:
+                log.LogInfo(f"[Dry-run] {scene_info['current_path']} -> {scene_info['final_path']}")
+                if DRY_RUN_JOURNAL:
+                    DRY_RUN_JOURNAL.write(f"{scene_id}|{scene_info['current_path']}|{scene_info['final_path']}")
+        else:
+            path_index.add(scene_id, scene_info['final_path'])
+            if executor:
+                executor.submit(scene_info)
+            else:
+                moved_scene(scene_info, undo_move(scene_info), db_writer, path_index)
+        db_writer.tick()
+        if executor:
+            executor.end_scene(total)
+        else:
+            log.LogProgress(progress / total)
+    if executor:
+        executor.close()
+    db_writer.close()
+    stash_db.close()
+    log.LogInfo("[SQLITE] Database closed!")
+    return sorted(db_writer.failed)
+
+
+def scene_files(stash_scene: dict) -> list:
+    """Files of the scene, the fields of the file refactor are used for the older Stash too."""
     # refractor file support
     fingerprint = []
     if stash_scene.get("path"):
@@ -1059,160 +2768,653 @@ def renamer(scene_id, db_conn=None):
         del stash_scene["files"]
     else:
         scene_files = []
-    stash_db = None
-    for i in range(0, len(scene_files)):
-        scene_file = scene_files[i]
-        # refractor file support
-        for f in scene_file["fingerprints"]:
-            if f.get("oshash"):
-                stash_scene["oshash"] = f["oshash"]
-            if f.get("md5"):
-                stash_scene["checksum"] = f["md5"]
-        stash_scene["path"] = scene_file["path"]
-        stash_scene["file"] = scene_file
-        if scene_file.get("bit_rate"):
-            stash_scene["file"]["bitrate"] = scene_file["bit_rate"]
-        if scene_file.get("frame_rate"):
-            stash_scene["file"]["framerate"] = scene_file["frame_rate"]
-
-        # Tags > Studios > Default
-        template = {}
-        template["filename"] = get_template_filename(stash_scene)
-        template["path"] = get_template_path(stash_scene)
-        if not template["path"].get("destination"):
-            if config.p_use_default_template:
-                log.LogDebug("[PATH] Using default template")
-                template["path"] = {"destination": config.p_default_template, "option": [], "opt_details": {}}
-            else:
-                template["path"] = None
+    return scene_files
+
+
+def use_scene_file(stash_scene: dict, scene_file: dict):
+    # refractor file support
+    for f in scene_file["fingerprints"]:
+        if f.get("oshash"):
+            stash_scene["oshash"] = f["oshash"]
+        if f.get("md5"):
+            stash_scene["checksum"] = f["md5"]
+    stash_scene["path"] = scene_file["path"]
+    stash_scene["file"] = scene_file
+    if scene_file.get("bit_rate"):
+        stash_scene["file"]["bitrate"] = scene_file["bit_rate"]
+    if scene_file.get("frame_rate"):
+        stash_scene["file"]["framerate"] = scene_file["frame_rate"]
+
+
+def render_scene_file(stash_scene: dict, scene_id, file_index: int):
+    """Find the template of the file and render its new path.
+
+    Return (template, scene_information, dry_run option of the template), None if there is no template.
+    """
+    option_dryrun = False
+    # Tags > Studios > Default
+    template = {}
+    template["filename"] = get_template_filename(stash_scene)
+    template["path"] = get_template_path(stash_scene)
+    if not template["path"].get("destination"):
+        if config.p_use_default_template:
+            log.LogDebug("[PATH] Using default template")
+            template["path"] = {"destination": config.p_default_template, "option": [], "opt_details": {}}
         else:
-            if template["path"].get("option"):
-                if "dry_run" in template["path"]["option"] and not DRY_RUN:
-                    log.LogInfo("Dry-Run on (activate by option)")
-                    option_dryrun = True
-        if not template["filename"] and config.use_default_template:
-            log.LogDebug("[FILENAME] Using default template")
-            template["filename"] = config.default_template
-
-        if not template["filename"] and not template["path"]:
-            log.LogWarning(f"[{scene_id}] No template for this scene.")
-            return
+            template["path"] = None
+    else:
+        if template["path"].get("option"):
+            if "dry_run" in template["path"]["option"] and not DRY_RUN:
+                log.LogInfo("Dry-Run on (activate by option)")
+                option_dryrun = True
+    if not template["filename"] and config.use_default_template:
+        log.LogDebug("[FILENAME] Using default template")
+        template["filename"] = config.default_template
+
+    if not template["filename"] and not template["path"]:
+        return None
 
-        #log.LogDebug("Using this template: {}".format(filename_template))
-        scene_information = extract_info(stash_scene, template)
-        log.LogDebug(f"[{scene_id}] Scene information: {scene_information}")
-        log.LogDebug(f"[{scene_id}] Template: {template}")
+    #log.LogDebug("Using this template: {}".format(filename_template))
+    scene_information = extract_info(stash_scene, template)
 
-        scene_information['scene_id'] = scene_id
-        scene_information['file_index'] = i
+    scene_information['scene_id'] = scene_id
+    scene_information['file_index'] = file_index
 
-        for removed_field in ORDER_SHORTFIELD:
-            if removed_field:
-                if scene_information.get(removed_field.replace("$", "")):
-                    del scene_information[removed_field.replace("$", "")]
-                    log.LogWarning(f"removed {removed_field} to reduce the length path")
-                else:
-                    continue
-            if template["filename"]:
-                scene_information['new_filename'] = create_new_filename(scene_information, template["filename"])
-            else:
-                scene_information['new_filename'] = scene_information['current_filename']
-            if template.get("path"):
-                scene_information['new_directory'] = create_new_path(scene_information, template)
+    for removed_field in ORDER_SHORTFIELD:
+        if removed_field:
+            if scene_information.get(removed_field.replace("$", "")):
+                del scene_information[removed_field.replace("$", "")]
+                log.LogWarning(f"removed {removed_field} to reduce the length path")
             else:
-                scene_information['new_directory'] = scene_information['current_directory']
-            scene_information['final_path'] = os.path.join(scene_information['new_directory'], scene_information['new_filename'])
-            # check length of path
-            if IGNORE_PATH_LENGTH or len(scene_information['final_path']) <= 240:
-                break
+                continue
+        if template["filename"]:
+            scene_information['new_filename'] = create_new_filename(scene_information, template["filename"])
+        else:
+            scene_information['new_filename'] = scene_information['current_filename']
+        if template.get("path"):
+            scene_information['new_directory'] = create_new_path(scene_information, template)
+        else:
+            scene_information['new_directory'] = scene_information['current_directory']
+        scene_information['final_path'] = os.path.join(scene_information['new_directory'], scene_information['new_filename'])
+        # check length of path
+        if IGNORE_PATH_LENGTH or len(scene_information['final_path']) <= 240:
+            break
+    return template, scene_information, option_dryrun
+
+
+def render_worker_init():
+    global GRAPHQL_CLIENT
+    # the connection belongs to the main process, a scene that needs Stash is rendered by the main process
+    GRAPHQL_CLIENT = None
+    if PHASE_STATS:
+        # the copy of the main process stats, they are already counted there
+        PHASE_STATS.lock = threading.Lock()
+        PHASE_STATS.reset()
+
+
+def render_scenes(data: bytes) -> tuple:
+    """Worker of the render pool: render the files of a chunk of scenes.
+
+    Return, for each scene, the result of render_scene_file for each of its files or None
+    if the main process has to do it. And the phase stats of the chunk (performance_stats).
+    """
+    results = []
+    for stash_scene in pickle.loads(data):
+        rendered = None
+        if not config.only_organized or stash_scene['organized'] or PATH_NON_ORGANIZED:
+            try:
+                rendered = []
+                for i, scene_file in enumerate(scene_files(stash_scene)):
+                    use_scene_file(stash_scene, scene_file)
+                    rendered.append(render_scene_file(stash_scene, stash_scene['id'], i))
+            except Exception:
+                rendered = None
+        results.append(rendered)
+    log.flush()
+    return results, PHASE_STATS.take() if PHASE_STATS else None
+
+
+def render_pool(workers: int, count=None):
+    """Process pool rendering the templates of the task renamer (plan_workers), None if it isn't worth/possible.
+
+    The workers are forked at once: it must be called before the threads of the run
+    (page prefetch, moves) start, a lock held by one of them would stay locked in the workers.
+    """
+    if workers <= 1 or (count is not None and count < RENDER_CHUNK_SIZE * 2):
+        return None
+    if "fork" not in multiprocessing.get_all_start_methods():
+        log.LogWarning("plan_workers needs Linux/macOS, the templates are rendered in the main process")
+        return None
+    # the workers get a copy of the index, they can't ask Stash
+    if STUDIO_INDEX.studios is None:
+        STUDIO_INDEX.load()
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"), initializer=render_worker_init)
+    # with fork, the first task starts all the workers
+    pool.submit(os.getpid).result()
+    return pool
+
+
+def render_pages(pages, pool):
+    """Yield (total, scene, rendered) for the scenes of pages in their order.
+
+    With a pool, the chunks of scenes are rendered ahead in the workers while the main process renames.
+    """
+    if pool is None:
+        for total, scenes in pages:
+            for scene in scenes:
+                yield total, scene, None
+        return
+    pending = deque()
+    lookahead = pool._max_workers * 2
+
+    def ready(keep):
+        while len(pending) > keep:
+            total, chunk, future = pending.popleft()
+            try:
+                results, phases = future.result()
+            except Exception as err:
+                log.LogWarning(f"Render pool failed ({err}), rendering {len(chunk)} scene(s) in the main process")
+                results, phases = [None] * len(chunk), None
+            if phases:
+                PHASE_STATS.merge(phases)
+            for scene, rendered in zip(chunk, results):
+                yield total, scene, rendered
+
+    for total, scenes in pages:
+        for start in range(0, len(scenes), RENDER_CHUNK_SIZE):
+            chunk = scenes[start:start + RENDER_CHUNK_SIZE]
+            # serialized now, renamer changes the scenes
+            pending.append((total, chunk, pool.submit(render_scenes, pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL))))
+            yield from ready(lookahead)
+    yield from ready(0)
+
+
+def renamer(scene_id, db_writer=None, path_index=None, executor=None, render_cache=None, plan=None, rendered=None):
+    option_dryrun = False
+    if type(scene_id) is dict:
+        stash_scene = scene_id
+        scene_id = stash_scene['id']
+    elif type(scene_id) is int:
+        stash_scene = graphql_getScene(scene_id)
+
+    if config.only_organized and not stash_scene['organized'] and not PATH_NON_ORGANIZED:
+        log.LogDebug("[%s] Scene ignored (not organized)", scene_id)
+        return
+
+    files = scene_files(stash_scene)
+    stash_db = None
+    for i in range(0, len(files)):
+        use_scene_file(stash_scene, files[i])
+
+        if render_cache:
+            metadata = render_cache.metadata(stash_scene)
+            if render_cache.check(scene_id, i, metadata, stash_scene["path"]):
+                log.LogInfo("Everything is ok. (%s)", os.path.basename(stash_scene['path']))
+                continue
+
+        if rendered is not None:
+            render = rendered[i]
+        else:
+            render = render_scene_file(stash_scene, scene_id, i)
+        if render is None:
+            log.LogWarning(f"[{scene_id}] No template for this scene.")
+            return
+        template, scene_information, file_dryrun = render
+        if file_dryrun:
+            option_dryrun = True
+        log.LogDebug("[%s] Scene information: %s", scene_id, scene_information)
+        log.LogDebug("[%s] Template: %s", scene_id, template)
 
         if check_longpath(scene_information['final_path']):
-            if (DRY_RUN or option_dryrun) and LOGFILE:
-                with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
-                    f.write(f"[LENGTH LIMIT] {scene_information['scene_id']}|{scene_information['final_path']}\n")
+            if (DRY_RUN or option_dryrun) and DRY_RUN_JOURNAL:
+                DRY_RUN_JOURNAL.write(f"[LENGTH LIMIT] {scene_information['scene_id']}|{scene_information['final_path']}")
             continue
 
         #log.LogDebug(f"Filename: {scene_information['current_filename']} -> {scene_information['new_filename']}")
         #log.LogDebug(f"Path: {scene_information['current_directory']} -> {scene_information['new_directory']}")
 
         if scene_information['final_path'] == scene_information['current_path']:
-            log.LogInfo(f"Everything is ok. ({scene_information['current_filename']})")
+            log.LogInfo("Everything is ok. (%s)", scene_information['current_filename'])
+            if render_cache:
+                render_cache.save(scene_id, i, metadata, scene_information['current_path'])
             continue
 
         if scene_information['current_directory'] != scene_information['new_directory']:
             log.LogInfo("File will be moved to another directory")
-            log.LogDebug(f"[OLD path] {scene_information['current_path']}")
-            log.LogDebug(f"[NEW path] {scene_information['final_path']}")
+            log.LogDebug("[OLD path] %s", scene_information['current_path'])
+            log.LogDebug("[NEW path] %s", scene_information['final_path'])
 
         if scene_information['current_filename'] != scene_information['new_filename']:
             log.LogInfo("The filename will be changed")
             if ALT_DIFF_DISPLAY:
                 find_diff_text(scene_information['current_filename'], scene_information['new_filename'])
             else:
-                log.LogDebug(f"[OLD filename] {scene_information['current_filename']}")
-                log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
+                log.LogDebug("[OLD filename] %s", scene_information['current_filename'])
+                log.LogDebug("[NEW filename] %s", scene_information['new_filename'])
 
-        if (DRY_RUN or option_dryrun) and LOGFILE:
-            with open(DRY_RUN_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"{scene_information['scene_id']}|{scene_information['current_path']}|{scene_information['final_path']}\n")
+        # the plan is not a change, only dry_run from the template options applies
+        if ((DRY_RUN and plan is None) or option_dryrun) and DRY_RUN_JOURNAL:
+            DRY_RUN_JOURNAL.write(f"{scene_information['scene_id']}|{scene_information['current_path']}|{scene_information['final_path']}")
             continue
         # check if there is already a file where the new path is
-        err = checking_duplicate_db(scene_information)
+        err = checking_duplicate_db(scene_information, path_index)
         while err and scene_information['file_index']<=len(DUPLICATE_SUFFIX):
             log.LogDebug("Duplicate filename detected, increasing file index")
             scene_information['file_index'] = scene_information['file_index'] + 1
             scene_information['new_filename'] = create_new_filename(scene_information, template["filename"])
             scene_information['final_path'] = os.path.join(scene_information['new_directory'], scene_information['new_filename'])
-            log.LogDebug(f"[NEW filename] {scene_information['new_filename']}")
-            log.LogDebug(f"[NEW path] {scene_information['final_path']}")
-            err = checking_duplicate_db(scene_information)
+            log.LogDebug("[NEW filename] %s", scene_information['new_filename'])
+            log.LogDebug("[NEW path] %s", scene_information['final_path'])
+            err = checking_duplicate_db(scene_information, path_index)
         # abort
         if err:
             raise Exception("duplicate")
+        if path_index is not None:
+            # claim the new path, other scenes of the batch can't use it anymore
+            path_index.add(scene_id, scene_information['final_path'])
+        scene_information['rename_associated'] = i == 0
+        if template.get("path"):
+            if "clean_tag" in template["path"]["option"]:
+                scene_information['clean_tag'] = template["path"]["opt_details"]["clean_tag"]
+        if plan:
+            plan.add(scene_information)
+            continue
         # connect to the db
-        if not db_conn:
+        if db_writer is None:
             stash_db = connect_db(STASH_DATABASE)
             if stash_db is None:
                 return
+            db_writer = DatabaseWriter(stash_db)
+        if executor:
+            executor.submit(scene_information)
         else:
-            stash_db = db_conn
+            moved_scene(scene_information, move_scene(scene_information), db_writer, path_index)
+    if stash_db:
+        db_writer.close()
+        stash_db.close()
+        log.LogInfo("[SQLITE] Database updated and closed!")
+
+
+class DaemonOutput:
+    """stderr of the daemon while it handles a hook, sent to the hook process (which gives it to Stash)."""
+
+    def __init__(self, conn: socket.socket):
+        self.stream = conn.makefile('w', encoding='utf-8')
+        self.closed = False
+
+    def write(self, text: str):
+        if self.closed:
+            return
         try:
-            # rename file on your disk
-            err = file_rename(scene_information['current_path'], scene_information['final_path'], scene_information)
-            if err:
-                raise Exception("rename")
-            # rename file on your db
+            self.stream.write(text)
+        except OSError:
+            # the hook process is gone, keep working
+            self.closed = True
+
+    def flush(self):
+        self.write("")
+        if not self.closed:
             try:
-                if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
-                    db_rename_refactor(stash_db, scene_information)
-                else:
-                    db_rename(stash_db, scene_information)
-            except Exception as err:
-                log.LogError(f"error when trying to update the database ({err}), revert the move...")
-                err = file_rename(scene_information['final_path'], scene_information['current_path'], scene_information)
-                if err:
-                    raise Exception("rename")
-                raise Exception("database update")
-            if i == 0:
-                associated_rename(scene_information)
-            if template.get("path"):
-                if "clean_tag" in template["path"]["option"]:
-                    graphql_removeScenesTag([scene_information['scene_id']], template["path"]["opt_details"]["clean_tag"])
+                self.stream.flush()
+            except OSError:
+                self.closed = True
+
+
+def daemon_files_time():
+    # a change of the config or of the plugin needs a new daemon
+    return [os.path.getmtime(f) for f in (config.__file__, __file__, log.__file__)]
+
+
+def daemon_handle(conn: socket.socket, fragment: dict, stash_db: sqlite3.Connection):
+    global START_TIME
+    START_TIME = time.time()
+    output = DaemonOutput(conn)
+    stderr = sys.stderr
+    sys.stderr = output
+    try:
+        log.LogDebug("--Starting Hook 'Renamer' (daemon)--")
+        STUDIO_INDEX.refresh()
+        db_writer = DatabaseWriter(stash_db) if stash_db else None
+        try:
+            renamer(fragment["args"]["hookContext"]["id"], db_writer)
         except Exception as err:
-            log.LogError(f"Error during database operation ({err})")
-            if not db_conn:
-                log.LogDebug("[SQLITE] Database closed")
-                stash_db.close()
+            log.LogError(f"main function error: {err}")
+            traceback.print_exc()
+        finally:
+            if db_writer:
+                db_writer.close()
+            DEFERRED_FOLDERS.sweep()
+        log.LogDebug("Execution time: {}s".format(round(time.time() - START_TIME, 5)))
+        if PHASE_STATS:
+            performance_report()
+            PHASE_STATS.reset()
+        # reopened by the next hook, the file may be moved/deleted meanwhile
+        close_journals()
+        # everything logged for this hook goes to its own output
+        log.flush()
+        output.write("\0" + json.dumps({"output": "Successful!", "error": None}) + "\n")
+        output.flush()
+    finally:
+        log.flush()
+        sys.stderr = stderr
+
+
+def daemon_serve():
+    """Handle the hooks sent on DAEMON_SOCKET until nothing comes for daemon_idle_timeout seconds."""
+    if not daemon_folder():
+        return
+    lock = lock_file(DAEMON_SOCKET + ".lock")
+    if lock is None:
+        # another daemon is running
+        return
+    if os.path.exists(DAEMON_SOCKET):
+        os.remove(DAEMON_SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # the socket is only usable by the user from its creation
+    umask = os.umask(0o077)
+    try:
+        server.bind(DAEMON_SOCKET)
+    finally:
+        os.umask(umask)
+    server.listen(64)
+    server.settimeout(config.daemon_idle_timeout or None)
+    files_time = daemon_files_time()
+    stash_db = connect_db(STASH_DATABASE)
+    conn = None
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            conn.settimeout(None)
+            try:
+                fragment = json.loads(conn.makefile('r', encoding='utf-8').readline())
+            except Exception:
+                conn.close()
+                continue
+            # the hook process handles it when the daemon can't
+            if daemon_files_time() != files_time or fragment.get("server_connection") != FRAGMENT_SERVER:
+                break
+            with conn:
+                daemon_handle(conn, fragment, stash_db)
+            conn = None
+    finally:
+        # free the socket before answering, so the hook can start a new daemon
+        server.close()
+        os.remove(DAEMON_SOCKET)
+        unlock_file(lock)
+        if conn:
+            conn.close()
+        if stash_db:
+            stash_db.close()
+
+
+def renamer_bulk(pages, plan_file=None, count=None, scene_done=None) -> list:
+    """Rename the scenes given by graphql_findScenePages, with one database connection and batched transactions.
+
+    count is the number of scenes when it's known before asking for them, scene_done(id)
+    is called when the moves of a scene are done.
+    Return the ids of the scenes that failed.
+    """
+    # before the first page, its prefetch thread must not exist when the workers are forked
+    pool = render_pool(config.plan_workers, count)
+    pages = iter(pages)
+    first_page = next(pages, (0, []))
+    if pool and first_page[0] < RENDER_CHUNK_SIZE * 2:
+        pool.shutdown()
+        pool = None
+    if not first_page[0]:
+        log.LogInfo("No scene to check")
+        return []
+    stash_db = connect_db(STASH_DATABASE)
+    if stash_db is None:
+        exit_plugin()
+    path_index = PathIndex(stash_db)
+    db_writer = DatabaseWriter(stash_db, config.db_batch_size, config.db_batch_time, path_index, preload_folders=True)
+    executor = None
+    if config.bulk_workers > 1:
+        executor = RenameExecutor(db_writer, path_index, config.bulk_workers)
+    plan = None
+    if plan_file:
+        plan = RenamePlan(plan_file, db_writer.folders)
+    render_cache = None
+    if config.render_cache_size > 0:
+        try:
+            render_cache = RenderCache(RENDER_CACHE_FILE, config.render_cache_size, CONFIG_FINGERPRINT)
+        except sqlite3.Error as err:
+            log.LogWarning(f"[Cache] Can't open the rendered path cache ({err})")
+    progress = 0
+    for total, scene, rendered in render_pages(itertools.chain([first_page], pages), pool):
+        if progress == 0:
+            log.LogDebug(f"Count scenes: {total}")
+        log.LogDebug("** Checking scene: %s - %s **", scene['title'], scene['id'])
+        try:
+            renamer(scene, db_writer, path_index, executor, render_cache, plan, rendered)
+        except Exception as err:
+            log.LogError(f"main function error: {err}")
+            db_writer.failed.add(int(scene['id']))
+        db_writer.tick()
+        progress += 1
+        if executor:
+            # the progress is given when the moves of the scene are done
+            executor.end_scene(total, functools.partial(scene_done, int(scene['id'])) if scene_done else None)
+        else:
+            log.LogProgress(progress / total)
+            if scene_done:
+                scene_done(int(scene['id']))
+    if pool:
+        pool.shutdown()
+    if executor:
+        executor.close()
+    if render_cache:
+        render_cache.close()
+    if plan:
+        plan.close()
+    db_writer.close()
+    stash_db.close()
+    log.LogInfo("[SQLITE] Database closed!")
+    return sorted(db_writer.failed)
+
+
+def config_fingerprint() -> str:
+    """Hash of the settings and of the plugin code, it changes when the renamed paths could change."""
+    settings = {}
+    for name, value in vars(config).items():
+        if name.startswith("_") or name in CONFIG_FINGERPRINT_IGNORED or callable(value) or isinstance(value, types.ModuleType):
             continue
-    if not db_conn and stash_db:
-        stash_db.close()
-        log.LogInfo("[SQLITE] Database updated and closed!")
+        settings[name] = value
+    fingerprint = hashlib.sha1(json.dumps(settings, sort_keys=True, default=repr).encode())
+    with open(__file__, 'rb') as f:
+        fingerprint.update(f.read())
+    return fingerprint.hexdigest()
+
+
+def incremental_pages(watermark: str, retry: list):
+    """findScenes pages of the scenes updated after the watermark, the scenes to retry first.
+
+    The ids are collected first: a scene updated during the run would shift the pages of the
+    updated_at filter, and the scene at the page boundary would be missed by this run and the next.
+    """
+    retry = sorted({int(scene_id) for scene_id in retry or []})
+    updated = graphql_findSceneIds({"updated_at": {"value": watermark, "modifier": "GREATER_THAN"}})
+    scene_ids = retry + sorted(set(updated) - set(retry))
+    page_size = config.batch_page_size if config.batch_page_size > 0 else max(len(scene_ids), 1)
+    chunks = [scene_ids[start:start + page_size] for start in range(0, len(scene_ids), page_size)]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(graphql_findScene, len(chunks[0]), "ASC", 1, "id", chunks[0]) if chunks else None
+        for index in range(len(chunks)):
+            scenes = future.result()["scenes"]
+            # the next page is fetched while the current one is processed
+            if index + 1 < len(chunks):
+                future = executor.submit(graphql_findScene, len(chunks[index + 1]), "ASC", 1, "id", chunks[index + 1])
+            yield len(scene_ids), scenes
+
+
+def renamer_incremental():
+    """Rename the scenes updated since the last successful run (and the ones that failed), all of them if the config changed."""
+    # scenes updated during this run are checked by the next one
+    start = (datetime.now().astimezone() - timedelta(seconds=1)).isoformat("T", "seconds")
+    state = {}
+    if os.path.isfile(INCREMENTAL_STATE_FILE):
+        try:
+            with open(INCREMENTAL_STATE_FILE, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception as err:
+            log.LogWarning(f"Ignoring the state of the last run ({err})")
+    if state.get("config") == CONFIG_FINGERPRINT and state.get("watermark"):
+        log.LogInfo(f"Checking the scenes updated since {state['watermark']}")
+        failed = renamer_bulk(incremental_pages(state["watermark"], state.get("retry")))
+    else:
+        log.LogInfo("The config changed since the last run, checking all the scenes")
+        failed = renamer_bulk(graphql_findScenePages(-1, config.batch_page_size, "ASC"))
+    if DRY_RUN:
+        return
+    if failed:
+        log.LogWarning(f"{len(failed)} scene(s) will be checked again by the next run")
+    try:
+        with open(INCREMENTAL_STATE_FILE, 'w', encoding='utf-8') as f:
+            json.dump({"watermark": start, "config": CONFIG_FINGERPRINT, "retry": failed}, f)
+    except Exception as err:
+        log.LogError(f"Can't save the state of the run: {err}")
+
+
+class PhaseStats:
+    """Count, time and latency histogram of each phase of the run (performance_stats)."""
+
+    # upper bounds of the histogram buckets, in seconds
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # phase -> [count, total, max, buckets]
+        self.phases = {}
+
+    def record(self, phase: str, elapsed: float):
+        with self.lock:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = [0, 0.0, 0.0, [0] * len(self.BUCKETS)]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3][bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+
+    def wrap(self, phase: str, func):
+        """Return func timed as phase. Only used when enabled, so disabled costs nothing."""
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(phase, time.perf_counter() - start)
+        return timed
+
+    def quantile(self, phase: str, q: float) -> float:
+        # upper bound of the bucket holding the quantile, never more than the slowest call
+        count, _, slowest, buckets = self.phases[phase]
+        seen = 0
+        for bound, n in zip(self.BUCKETS, buckets):
+            seen += n
+            if seen >= q * count:
+                return min(bound, slowest)
+        return slowest
+
+    def summary(self) -> str:
+        with self.lock:
+            rows = [("phase", "count", "total s", "avg ms", "p50 ms", "p95 ms", "max ms")]
+            for phase, (count, total, slowest, _) in sorted(self.phases.items(), key=lambda x: -x[1][1]):
+                rows.append((phase, str(count), f"{total:.3f}", f"{total / count * 1000:.2f}",
+                             f"{self.quantile(phase, 0.5) * 1000:.2f}", f"{self.quantile(phase, 0.95) * 1000:.2f}",
+                             f"{slowest * 1000:.2f}"))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join("  ".join(cell.ljust(w) if i == 0 else cell.rjust(w) for i, (cell, w) in enumerate(zip(row, widths)))
+                         for row in rows)
+
+    def export(self, path: str):
+        """Write the stats to path, in the Prometheus textfile format if it ends with .prom, in JSON otherwise."""
+        with self.lock:
+            phases = {phase: (stats[0], stats[1], stats[2], list(stats[3])) for phase, stats in self.phases.items()}
+        if path.endswith(".prom"):
+            lines = ["# HELP renamer_phase_seconds Time spent in each phase of renamerOnUpdate.",
+                     "# TYPE renamer_phase_seconds histogram"]
+            for phase, (count, total, _, buckets) in sorted(phases.items()):
+                seen = 0
+                for bound, n in zip(self.BUCKETS, buckets):
+                    seen += n
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'renamer_phase_seconds_bucket{{phase="{phase}",le="{le}"}} {seen}')
+                lines.append(f'renamer_phase_seconds_sum{{phase="{phase}"}} {total}')
+                lines.append(f'renamer_phase_seconds_count{{phase="{phase}"}} {count}')
+            content = "\n".join(lines) + "\n"
+        else:
+            content = json.dumps({
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "buckets": [str(bound) for bound in self.BUCKETS],
+                "phases": {phase: {"count": count, "total": total, "max": slowest, "histogram": buckets}
+                           for phase, (count, total, slowest, buckets) in phases.items()},
+            }, indent=1)
+        # the textfile collector must never read a half written file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+
+    def take(self) -> dict:
+        """Return the stats recorded so far and start again (render workers)."""
+        with self.lock:
+            phases, self.phases = self.phases, {}
+        return phases
+
+    def merge(self, phases: dict):
+        """Add the stats returned by take() in another process."""
+        with self.lock:
+            for phase, (count, total, slowest, buckets) in phases.items():
+                stats = self.phases.get(phase)
+                if stats is None:
+                    stats = self.phases[phase] = [0, 0.0, 0.0, [0] * len(self.BUCKETS)]
+                stats[0] += count
+                stats[1] += total
+                stats[2] = max(stats[2], slowest)
+                stats[3] = [a + b for a, b in zip(stats[3], buckets)]
+
+
+def performance_report():
+    if not PHASE_STATS.phases:
+        return
+    log.LogInfo(f"Performance summary:\n{PHASE_STATS.summary()}")
+    if config.performance_stats_file:
+        try:
+            PHASE_STATS.export(config.performance_stats_file)
+        except OSError as err:
+            log.LogError(f"Can't write the performance stats: {err}")
+
+
+def close_journals():
+    for journal in (RENAME_JOURNAL, DRY_RUN_JOURNAL):
+        if journal:
+            try:
+                journal.close()
+            except OSError as err:
+                log.LogError(f"Can't write {journal.path}: {err}")
 
 
 def exit_plugin(msg=None, err=None):
     if msg is None and err is None:
         msg = "plugin ended"
     log.LogDebug("Execution time: {}s".format(round(time.time() - START_TIME, 5)))
+    if GRAPHQL_CLIENT:
+        log.LogDebug(f"GraphQL: {GRAPHQL_CLIENT.stats()}")
+    if DEFERRED_FOLDERS is not None:
+        DEFERRED_FOLDERS.sweep()
+    if PHASE_STATS:
+        performance_report()
+    close_journals()
     output_json = {"output": msg, "error": err}
     print(json.dumps(output_json))
     sys.exit()
@@ -1244,14 +3446,51 @@ else:
     FRAGMENT_HOOK_TYPE = FRAGMENT["args"]["hookContext"]["type"]
     FRAGMENT_SCENE_ID = FRAGMENT["args"]["hookContext"]["id"]
 
+# scenes sent at once to a worker of the render pool
+RENDER_CHUNK_SIZE = 50
+# edited by the tasks, they don't change the paths
+CONFIG_FINGERPRINT_IGNORED = ("enable_hook", "dry_run", "dry_run_append", "performance_stats", "performance_stats_file")
+INCREMENTAL_STATE_FILE = config.incremental_state_file or os.path.join(PLUGIN_DIR, "renamerOnUpdate_state.json")
+PLAN_FILE = config.plan_file or os.path.join(PLUGIN_DIR, "renamerOnUpdate_plan.jsonl")
+RENDER_CACHE_FILE = config.render_cache_file or os.path.join(PLUGIN_DIR, "renamerOnUpdate_cache.sqlite")
+
 LOGFILE = config.log_file
+RENAME_JOURNAL = RenameJournal(LOGFILE, config.log_file_sync) if LOGFILE else None
+DRY_RUN_JOURNAL = RenameJournal(DRY_RUN_FILE) if DRY_RUN_FILE else None
+# folders to check once the moves are done (FolderSweeper)
+DEFERRED_FOLDERS = None
+
+# function(s) timed for each phase when performance_stats is on
+PERFORMANCE_PHASES = {
+    "graphql": ("callGraphQL",),
+    "scene": ("renamer",),
+    "extract_info": ("extract_info",),
+    "render_filename": ("create_new_filename",),
+    "render_path": ("create_new_path",),
+    "duplicate_check": ("checking_duplicate_db",),
+    "file_rename": ("file_rename",),
+    "sqlite_update": ("db_rename", "db_rename_refactor"),
+    "remove_tag": ("graphql_removeScenesTag",),
+}
+if config.performance_stats:
+    PHASE_STATS = PhaseStats()
+    for phase, functions in PERFORMANCE_PHASES.items():
+        for name in functions:
+            globals()[name] = PHASE_STATS.wrap(phase, globals()[name])
 
 #Gallery.Update.Post
 #if FRAGMENT_HOOK_TYPE == "Scene.Update.Post":
 
 
-STASH_CONFIG = graphql_getConfiguration()
+GRAPHQL_CLIENT = GraphQLClient(FRAGMENT_SERVER)
+try:
+    STASH_CONFIG = graphql_getConfiguration()
+except ConnectionError as err:
+    exit_plugin(err=str(err))
 STASH_DATABASE = STASH_CONFIG['general']['databasePath']
+# one hook only needs the parents of its studio, the whole index is for the runs with many scenes
+STUDIO_INDEX = StudioIndex(config.studio_cache_file,
+                           preload=bool(DAEMON or PLUGIN_ARGS or HOOK_QUEUE_LOCK or config.studio_cache_file))
 
 # READING CONFIG
 
@@ -1266,6 +3505,7 @@ FILENAME_TITLECASE = config.titlecase_Filename
 FILENAME_SPLITCHAR = config.filename_splitchar
 FILENAME_REMOVECHARACTER = config.removecharac_Filename
 FILENAME_REPLACEWORDS = config.replace_words
+REPLACE_WORDS = compile_replace_words(FILENAME_REPLACEWORDS)
 
 PERFORMER_SPLITCHAR = config.performer_splitchar
 PERFORMER_LIMIT = config.performer_limit
@@ -1291,9 +3531,16 @@ IGNORE_PATH_LENGTH = config.ignore_path_length
 
 PREVENT_CONSECUTIVE = config.prevent_consecutive
 REMOVE_EMPTY_FOLDER = config.remove_emptyfolder
+DEFERRED_FOLDERS = FolderSweeper([stash['path'] for stash in STASH_CONFIG['general'].get('stashes') or []],
+                                 config.remove_emptyfolder_ignore, config.remove_emptyfolder_batch)
+
+MOVE_BUFFER_SIZE = config.move_buffer_size * 1048576
+MOVE_PROGRESS_INTERVAL = config.move_progress_interval
+MOVE_SYNC_SIZE = config.move_sync_size * 1048576
 
 PROCESS_KILL = config.process_kill_attach
 PROCESS_ALLRESULT = config.process_getall
+OPEN_FILES = OpenFileIndex(config.process_cache_time)
 UNICODE_USE = config.use_ascii
 
 ORDER_SHORTFIELD = config.order_field
@@ -1306,7 +3553,10 @@ PATH_KEEP_ALRPERF = config.path_keep_alrperf
 PATH_NON_ORGANIZED = config.p_non_organized
 PATH_ONEPERFORMER = config.path_one_performer
 
-DB_VERSION = graphql_getBuild()
+try:
+    DB_VERSION = graphql_getBuild()
+except ConnectionError as err:
+    exit_plugin(err=str(err))
 if DB_VERSION >= DB_VERSION_FILE_REFACTOR:
     FILE_QUERY = """
             files {
@@ -1339,32 +3589,49 @@ else:
     """
 if DB_VERSION >= DB_VERSION_SCENE_STUDIO_CODE:
     FILE_QUERY = f"        code{FILE_QUERY}"
+CONFIG_FINGERPRINT = config_fingerprint()
 
-if PLUGIN_ARGS:
-    if "bulk" in PLUGIN_ARGS:
-        scenes = graphql_findScene(config.batch_number_scene, "ASC")
-        log.LogDebug(f"Count scenes: {len(scenes['scenes'])}")
-        progress = 0
-        progress_step = 1 / len(scenes['scenes'])
-        stash_db = connect_db(STASH_DATABASE)
-        if stash_db is None:
-            exit_plugin()
-        for scene in scenes['scenes']:
-            log.LogDebug(f"** Checking scene: {scene['title']} - {scene['id']} **")
-            try:
-                renamer(scene, stash_db)
-            except Exception as err:
-                log.LogError(f"main function error: {err}")
-            progress += progress_step
-            log.LogProgress(progress)
-        stash_db.close()
-        log.LogInfo("[SQLITE] Database closed!")
-else:
-    try:
-        renamer(FRAGMENT_SCENE_ID)
-    except Exception as err:
-        log.LogError(f"main function error: {err}")
-        traceback.print_exc()
+# Stash can't be reached (or the circuit is open), end with an error instead of a traceback
+try:
+    if DAEMON:
+        daemon_serve()
+    elif PLUGIN_ARGS:
+        if "undo" in PLUGIN_ARGS:
+            renamer_undo(preview="preview" in PLUGIN_ARGS)
+        elif "plan" in PLUGIN_ARGS:
+            renamer_bulk(scene_pages(config.batch_number_scene, config.batch_page_size), PLAN_FILE)
+        elif "apply" in PLUGIN_ARGS:
+            renamer_apply(PLAN_FILE)
+        elif "incremental" in PLUGIN_ARGS:
+            renamer_incremental()
+        elif "bulk" in PLUGIN_ARGS:
+            renamer_bulk(scene_pages(config.batch_number_scene, config.batch_page_size))
+    elif HOOK_QUEUE_LOCK:
+        while HOOK_QUEUE_LOCK:
+            hook_queue_recover()
+            scene_ids = hook_queue_take()
+            while scene_ids:
+                log.LogInfo(f"Renaming {len(scene_ids)} queued scene(s)")
+                renamer_bulk(scene_pages(-1, config.batch_page_size, scene_ids), count=len(scene_ids), scene_done=hook_queue_done)
+                # the scenes Stash didn't return (deleted since)
+                for scene_id in scene_ids:
+                    hook_queue_done(scene_id)
+                scene_ids = hook_queue_take()
+            unlock_file(HOOK_QUEUE_LOCK)
+            HOOK_QUEUE_LOCK = None
+            # a hook may have queued a scene while the lock was released
+            if hook_queue_scenes():
+                HOOK_QUEUE_LOCK = lock_file(os.path.join(HOOK_QUEUE_DIR, "queue.lock"))
+    else:
+        try:
+            renamer(FRAGMENT_SCENE_ID)
+        except ConnectionError:
+            raise
+        except Exception as err:
+            log.LogError(f"main function error: {err}")
+            traceback.print_exc()
+except ConnectionError as err:
+    exit_plugin(err=str(err))
 
 exit_plugin("Successful!")
 
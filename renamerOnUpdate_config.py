@@ -114,9 +114,23 @@ p_tag_option = {
 #               Logging              #
 
 # File to save what is renamed, can be useful if you need to revert changes.
-# Will look like: IDSCENE|OLD_PATH|NEW_PATH
+# Will look like: IDSCENE|OLD_PATH|NEW_PATH|OSHASH|TIME (associated files have no OSHASH)
 # Leave Blank ("") or use None if you don't want to use a log file, or a working path like: C:\Users\USERNAME\.stash\plugins\Hooks\rename_log.txt
 log_file = r""
+# The log file is written to the disk (fsync) at most every log_file_sync milliseconds and before every save in the Stash database,
+# so a crash never loses a rename that Stash knows. 0 = after every file (slow on network drives)
+log_file_sync = 1000
+# Minimum level of the messages sent to Stash: "trace", "debug", "info", "warning" or "error".
+# On big tasks, "info" saves the time spent to build the debug messages (scene information, template...).
+log_level = "debug"
+
+######################################
+#               Caching              #
+
+# File to keep the studio hierarchy between runs (refreshed when a studio is added/updated in Stash). With it, a hook loads all the studios
+# like the task does, without it a hook only asks Stash for the parents of the studio of its scene.
+# Leave Blank ("") to always ask Stash, or use a working path like: C:\Users\USERNAME\.stash\plugins\Hooks\renamerOnUpdate_studios.json
+studio_cache_file = r""
 
 ######################################
 #               Settings             #
@@ -190,7 +204,20 @@ prevent_title_performer = False
 # remove consecutive (/FolderName/FolderName/video.mp4 -> FolderName/video.mp4
 prevent_consecutive = True
 # check when the file has moved that the old directory is empty, if empty it will remove it.
+# The folders are checked once all the moves are done, a parent left empty is removed too (up to the library folder).
 remove_emptyfolder = True
+# files that don't prevent the removal of a folder, they are deleted with it (case insensitive).
+# Empty = a folder with any file is kept. e.g. [".DS_Store", "Thumbs.db"] (desktop.ini holds the Windows folder customisation)
+remove_emptyfolder_ignore = []
+# number of folders checked at once (in parallel with bulk_workers)
+remove_emptyfolder_batch = 100
+# when a file is moved to another disk, it is copied (by chunk of move_buffer_size MB) to 'filename.renamerpart' then renamed.
+# If the plugin is stopped during the copy, the next run continues it if the original file didn't change (its size/date/hash are kept in 'filename.renamerpart.source').
+move_buffer_size = 16
+# the copy is written to the disk every X MB, a stopped copy is continued from the last of these points (then compared entirely with the original)
+move_sync_size = 256
+# show the progress of these copies every X seconds (in debug log)
+move_progress_interval = 10
 # the folder only contains 1 performer name. Else it will look the same as for filename
 path_one_performer = True
 # if there is no performer on the scene, the $performer field will be replaced by "NoPerformer" so a folder "NoPerformer" will be created
@@ -244,8 +271,45 @@ order_field = ["$video_codec", "$audio_codec", "$resolution", "tags", "rating",
 # Alternate way to show diff. Not useful at all.
 alt_diff_display = False
 
+# the task renamer saves the renamed scenes in the Stash database by batch:
+# a batch is written when it has db_batch_size scenes or when its first scene is older than db_batch_time milliseconds
+db_batch_size = 50
+db_batch_time = 1000
+
+# number of files moved at the same time by the task renamer. 1 = one after the other.
+# More than 1 helps when the files are moved to another disk/NAS. The database is still updated in the same order.
+bulk_workers = 1
+# number of processes rendering the templates for the task renamer (one per CPU core at most), the renames are still done
+# in the same order by the main process. Helps with big libraries and complex templates. 1 = in the main process. Linux/macOS only
+plan_workers = 1
+
 # number of scene process by the task renamer. -1 = all scenes
 batch_number_scene = -1
+# number of scenes requested from Stash at once by the task renamer, the next page is fetched while the current one is renamed.
+# -1 = everything in one request (uses a lot of memory on big libraries)
+batch_page_size = 500
+# the task renamer reads the scenes directly from the Stash database (read-only) instead of asking Stash for them,
+# faster on big libraries. Stash is asked if the database can't be read.
+bulk_read_db = False
+# the task 'Plan renames' writes the renames it would do in this file (one JSON per line: paths, associated files, folder ids, size/oshash of the file)
+# without moving anything. You can review/edit it, then the task 'Apply plan' does them (without asking Stash for the scenes again).
+# Empty = renamerOnUpdate_plan.jsonl in the plugin folder
+plan_file = r""
+# the task 'Rename changed scenes' only checks the scenes updated since its last run (and the ones it failed to rename).
+# It checks all of them again when this file or the plugin changed. The state of the last run is kept in this file.
+# Empty = renamerOnUpdate_state.json in the plugin folder
+incremental_state_file = r""
+# the task renamer remembers the scenes that are already at the right place. They are skipped by the next run if
+# nothing changed on them (metadata, file, studio). Forgotten when this file or the plugin changes.
+# Maximum number of files kept (the least recently checked are removed first). 0 = disabled
+render_cache_size = 200000
+# Empty = renamerOnUpdate_cache.sqlite in the plugin folder
+render_cache_file = r""
+# the task 'Undo renames' moves back the files renamed in log_file (the database too), 'Undo renames (preview)' only shows them.
+# Only the renames done from undo_since and before undo_until ("2024-05-01" or "2024-05-01T20:30:00"), of the scenes in undo_scene_ids. Empty = all
+undo_since = ""
+undo_until = ""
+undo_scene_ids = []
 
 # disable/enable the hook. You can edit this value in 'Plugin Tasks' inside of Stash.
 enable_hook = True
@@ -254,16 +318,52 @@ enable_hook = True
 dry_run = False
 # Choose if you want to append to (True) or overwrite (False) the dry-run log file.
 dry_run_append = True
+# time each step (GraphQL, extract_info, templates, duplicate check, file move, database...) and show a summary at the end.
+performance_stats = False
+# also write the stats in this file: Prometheus textfile (node_exporter) if it ends with .prom, JSON otherwise. Empty = no file
+performance_stats_file = r""
+######################################
+#            Connection              #
+
+# number of connections kept open to Stash
+graphql_pool_size = 4
+# seconds to wait for an answer from Stash
+graphql_timeout = 20
+# number of retries when Stash can't be reached (or answers 429/502/503/504), the wait doubles every retry
+graphql_retries = 3
+graphql_retry_backoff = 0.5
+# after this many failed requests in a row, stop calling Stash for graphql_breaker_cooldown seconds
+graphql_breaker_threshold = 5
+graphql_breaker_cooldown = 30
+
+# (Linux/macOS) the first hook starts a background process that handles the next hooks, so Python and the connection to Stash are ready.
+# It stops after daemon_idle_timeout seconds without hook, and restarts when this file or the plugin is edited.
+daemon_mode = False
+daemon_idle_timeout = 300
+# path of the socket used to talk to it. Empty = in a folder of your user in the temp folder (the folder must not be writable by other users)
+daemon_socket = r""
+
+# the hooks put the updated scenes in a queue (folder hook_queue_dir), the first hook waits until no scene was added
+# for hook_queue_delay seconds then renames all of them like the task renamer. Updating 500 scenes at once only runs one rename.
+# daemon_mode is not used with it.
+hook_queue = False
+hook_queue_delay = 2
+# Empty = 'hook_queue' folder in the plugin folder
+hook_queue_dir = r""
+
 ######################################
 #            Module Related          #
 
 # ! OPTIONAL module settings. Not needed for basic operation !
 
 # = psutil module (https://pypi.org/project/psutil/) =
-# Gets a list of all processes instead of stopping after the first one. Enabling it slows down the plugin
+# Gets a list of all processes using the file instead of only the first one.
 process_getall = False
 # If the file is used by a process, the plugin will kill it. IT CAN MAKE STASH CRASH TOO. 
+# (Windows: file in use error, Linux/macOS: busy error. A permission error never kills a process)
 process_kill_attach = False
+# The list of files opened by the processes is kept X seconds, so all the processes are not checked again for each file.
+process_cache_time = 10
 # =========================
 
 # = Unidecode module (https://pypi.org/project/Unidecode/) =